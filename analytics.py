@@ -0,0 +1,216 @@
+"""Circulation analytics for the AOA Library: daily rollups behind the dashboard API.
+
+CirculationDaily holds one row per (day, title, subject, staff member) with the
+checkouts made that day and the returns received that day (copies, loan days,
+and how many came back after their due date). "Staff" is the member who lent
+the copy (BookIssue.assigned_by, kept on the returns ledger). LoanSnapshot
+records, per run day, how many loans were open and overdue per subject and staff.
+
+The nightly 'analytics-rollup' job recomputes the days since the last run plus
+ANALYTICS_LOOKBACK_DAYS before it (returns can be entered with an earlier
+return date), so each run reads only recent index ranges of BookIssue and
+BookReturnDetail. Dashboard queries then sum a few hundred rollup rows per day
+instead of scanning loan history.
+
+    python analytics.py            # refresh now (what the job does)
+    python analytics.py --rebuild  # recompute every day from the beginning
+"""
+import csv
+import io
+import os
+import sys
+from datetime import timedelta
+
+import dbutil
+
+LOOKBACK_DAYS = int(os.getenv('ANALYTICS_LOOKBACK_DAYS', '14'))
+# Days shown by the dashboard when no range is given (about a school term)
+DEFAULT_RANGE_DAYS = 90
+TOP_TITLES = 10
+
+EXPORT_COLUMNS = ('day', 'title', 'subject', 'staff', 'checkouts', 'returns',
+                  'timed_returns', 'loan_days', 'dated_returns', 'overdue_returns')
+
+def watermark(cur):
+    """Last day a refresh covered, or None before the first one"""
+    cur.execute("SELECT processed_through FROM AnalyticsState")
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return row['processed_through'] if isinstance(row, dict) else row[0]
+
+def _first_day(cur):
+    cur.execute("SELECT LEAST((SELECT MIN(issue) FROM BookIssue), (SELECT MIN(issue) FROM BookReturnDetail), "
+                "(SELECT MIN(returned) FROM BookReturnDetail))")
+    row = cur.fetchone()
+    return row[0] if not isinstance(row, dict) else next(iter(row.values()))
+
+# Every checkout and return event in [start, end], one row per event, grouped per day.
+# Subjects come from the copy (deleted copies count as 'Unknown'); NULL staff is ''.
+_ROLLUP_SQL = """
+    INSERT INTO CirculationDaily(day, title, subject, staff, checkouts, returns, timed_returns,
+                                 loan_days, dated_returns, overdue_returns)
+    SELECT day, title, subject, staff, SUM(checkouts), SUM(returns), SUM(timed_returns),
+           SUM(loan_days), SUM(dated_returns), SUM(overdue_returns)
+    FROM (
+        SELECT i.issue AS day, COALESCE(b.title, '') AS title, COALESCE(b.subject, 'Unknown') AS subject,
+               COALESCE(i.assigned_by, '') AS staff, 1 AS checkouts, 0 AS returns, 0 AS timed_returns,
+               0 AS loan_days, 0 AS dated_returns, 0 AS overdue_returns
+        FROM BookIssue i LEFT JOIN Book b ON b.serial = i.serial
+        WHERE i.issue BETWEEN %(start)s AND %(end)s
+        UNION ALL
+        SELECT d.issue, d.title, COALESCE(b.subject, 'Unknown'), COALESCE(d.assigned_by, ''),
+               d.copies, 0, 0, 0, 0, 0
+        FROM BookReturnDetail d LEFT JOIN Book b ON b.book_id = d.book_id
+        WHERE d.issue BETWEEN %(start)s AND %(end)s
+        UNION ALL
+        SELECT d.returned, d.title, COALESCE(b.subject, 'Unknown'), COALESCE(d.assigned_by, ''),
+               0, d.copies,
+               CASE WHEN d.issue IS NOT NULL THEN d.copies ELSE 0 END,
+               CASE WHEN d.issue IS NOT NULL THEN GREATEST(d.returned - d.issue, 0) * d.copies ELSE 0 END,
+               CASE WHEN d.exp IS NOT NULL THEN d.copies ELSE 0 END,
+               CASE WHEN d.returned > d.exp THEN d.copies ELSE 0 END
+        FROM BookReturnDetail d LEFT JOIN Book b ON b.book_id = d.book_id
+        WHERE d.returned BETWEEN %(start)s AND %(end)s
+    ) events
+    GROUP BY day, title, subject, staff
+"""
+
+def refresh(cur, today, full=False):
+    """Recompute the rollups from the last run (minus the lookback) through `today`; returns a summary"""
+    since = None if full else watermark(cur)
+    start = _first_day(cur) if since is None else min(since, today) - timedelta(days=LOOKBACK_DAYS)
+    start = start or today
+    if since is None:
+        cur.execute("DELETE FROM CirculationDaily")
+    else:
+        cur.execute("DELETE FROM CirculationDaily WHERE day BETWEEN %s AND %s", (start, today))
+    cur.execute(_ROLLUP_SQL, {'start': start, 'end': today})
+    rows = cur.rowcount
+    cur.execute("DELETE FROM LoanSnapshot WHERE day = %s", (today,))
+    cur.execute("""
+        INSERT INTO LoanSnapshot(day, subject, staff, open_loans, overdue_loans)
+        SELECT %s, COALESCE(b.subject, 'Unknown'), COALESCE(i.assigned_by, ''),
+               COUNT(*), COUNT(*) FILTER (WHERE i.exp < %s)
+        FROM BookIssue i LEFT JOIN Book b ON b.serial = i.serial
+        GROUP BY 2, 3
+    """, (today, today))
+    cur.execute("""
+        INSERT INTO AnalyticsState(id, processed_through, refreshed_at) VALUES (TRUE, %s, now())
+        ON CONFLICT (id) DO UPDATE SET processed_through = EXCLUDED.processed_through, refreshed_at = now()
+    """, (today,))
+    return {'from': start, 'through': today, 'rollup_rows': rows}
+
+def _rate(part, whole):
+    return round(part / whole, 4) if whole else None
+
+def _average(total, count):
+    return round(total / count, 2) if count else None
+
+_SUMS = """SUM(checkouts) AS checkouts, SUM(returns) AS returns, SUM(timed_returns) AS timed_returns,
+           SUM(loan_days) AS loan_days, SUM(dated_returns) AS dated_returns, SUM(overdue_returns) AS overdue_returns"""
+
+def _summarize(row):
+    # SUM() comes back as Decimal (or None for no rows)
+    sums = {column: int(row[column] or 0) for column in EXPORT_COLUMNS[4:]}
+    return {
+        'checkouts': sums['checkouts'],
+        'returns': sums['returns'],
+        'average_loan_days': _average(sums['loan_days'], sums['timed_returns']),
+        'overdue_return_rate': _rate(sums['overdue_returns'], sums['dated_returns']),
+    }
+
+def dashboard(cur, start, end, top=TOP_TITLES):
+    """Circulation metrics for days start..end (inclusive), read from the rollups only"""
+    span = {'start': start, 'end': end}
+    cur.execute(f"SELECT {_SUMS} FROM CirculationDaily WHERE day BETWEEN %(start)s AND %(end)s", span)
+    totals = _summarize(dbutil.dict_rows(cur)[0])
+
+    cur.execute(f"""
+        SELECT day, {_SUMS} FROM CirculationDaily WHERE day BETWEEN %(start)s AND %(end)s
+        GROUP BY day ORDER BY day
+    """, span)
+    daily = [dict(_summarize(row), day=row['day'].isoformat()) for row in dbutil.dict_rows(cur)]
+
+    cur.execute("""
+        SELECT title, SUM(checkouts) AS checkouts FROM CirculationDaily
+        WHERE day BETWEEN %(start)s AND %(end)s
+        GROUP BY title HAVING SUM(checkouts) > 0
+        ORDER BY SUM(checkouts) DESC, title LIMIT %(top)s
+    """, dict(span, top=top))
+    top_titles = [{'title': row['title'], 'checkouts': int(row['checkouts'])} for row in dbutil.dict_rows(cur)]
+
+    cur.execute(f"""
+        SELECT subject, {_SUMS} FROM CirculationDaily WHERE day BETWEEN %(start)s AND %(end)s
+        GROUP BY subject ORDER BY subject
+    """, span)
+    subjects = [dict(_summarize(row), subject=row['subject']) for row in dbutil.dict_rows(cur)]
+
+    # Open and overdue loans now come from the latest snapshot on or before `end`
+    cur.execute(f"""
+        WITH circulation AS (
+            SELECT staff, {_SUMS} FROM CirculationDaily WHERE day BETWEEN %(start)s AND %(end)s GROUP BY staff
+        ),
+        snapshot AS (
+            SELECT staff, SUM(open_loans) AS open_loans, SUM(overdue_loans) AS overdue_loans
+            FROM LoanSnapshot
+            WHERE day = (SELECT MAX(day) FROM LoanSnapshot WHERE day <= %(end)s)
+            GROUP BY staff
+        )
+        SELECT COALESCE(c.staff, s.staff) AS staff, c.checkouts, c.returns, c.timed_returns, c.loan_days,
+               c.dated_returns, c.overdue_returns, s.open_loans, s.overdue_loans
+        FROM circulation c FULL JOIN snapshot s ON s.staff = c.staff
+        ORDER BY 1
+    """, span)
+    staff = [dict(_summarize(row), staff=row['staff'] or None,
+                  open_loans=int(row['open_loans'] or 0), overdue_loans=int(row['overdue_loans'] or 0),
+                  overdue_open_rate=_rate(int(row['overdue_loans'] or 0), int(row['open_loans'] or 0)))
+             for row in dbutil.dict_rows(cur)]
+
+    cur.execute("SELECT processed_through, refreshed_at FROM AnalyticsState")
+    state = dbutil.dict_rows(cur)
+    return {
+        'from': start.isoformat(), 'to': end.isoformat(),
+        'refreshed_at': state[0]['refreshed_at'].isoformat() if state and state[0]['refreshed_at'] else None,
+        'totals': totals, 'daily': daily, 'top_titles': top_titles, 'subjects': subjects, 'staff': staff,
+    }
+
+def export_csv(conn, start, end, chunk_rows=2000):
+    """Yield the rollup rows for days start..end as CSV text, header first"""
+    # Named cursor = server-side cursor: rows arrive in chunks instead of all at once
+    cur = conn.cursor(name='analytics_export')
+    cur.itersize = chunk_rows
+    cur.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM CirculationDaily "
+                "WHERE day BETWEEN %s AND %s ORDER BY day, title, subject, staff", (start, end))
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    try:
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                break
+            writer.writerows([row[column] for column in EXPORT_COLUMNS] if isinstance(row, dict) else row
+                             for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    finally:
+        cur.close()
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    import migrations
+    import reminders
+    conn = migrations.connect()
+    try:
+        summary = refresh(conn.cursor(), reminders.today(), full='--rebuild' in argv)
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"Analytics refreshed {summary['from']} - {summary['through']}: {summary['rollup_rows']} rollup row(s)")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""In-process cache for slow-changing reference data (staff list, student roster, titles).
+
+Each web worker keeps its own ReferenceCache: a read-through cache with a TTL
+(CACHE_TTL_SECONDS) and LRU eviction past CACHE_MAX_ENTRIES. Entries belong to a
+topic ('staff', 'students', 'titles'); a write that changes a topic calls
+invalidate(cur, topic), which drops the local entries and queues a Postgres
+NOTIFY in the same transaction. Every worker's Listener thread LISTENs for those
+notifications and drops its own entries once the write has committed; a rolled
+back write notifies nobody. Code without access to the cache object (the
+importer) calls notify() alone.
+
+The listener holds one connection of its own, outside the worker's pool: a
+session that LISTENs cannot be lent out. The README's connection budget counts it.
+If the listener loses its connection it may have missed notifications, so it
+clears the whole cache when it reconnects. The TTL bounds staleness either way.
+"""
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+
+TTL_SECONDS = float(os.getenv('CACHE_TTL_SECONDS', '300'))
+MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '256'))
+CHANNEL = 'aoa_reference_cache'
+# Every topic, for notify()/invalidate() callers that changed everything (dump restore)
+TOPICS = ('staff', 'students', 'titles')
+
+def notify(cur, *topics):
+    """Tell every worker (this one included) to drop `topics` once cur's transaction commits"""
+    for topic in topics or TOPICS:
+        cur.execute("SELECT pg_notify(%s, %s)", (CHANNEL, topic))
+
+class ReferenceCache:
+    """Thread-safe read-through cache keyed by (topic, key), with per-topic hit/miss counters"""
+    def __init__(self, ttl=TTL_SECONDS, max_entries=MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        # Bumped on every invalidation; a load that raced with one is not stored
+        self._generations = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _topic_stats(self, topic):
+        stats = self._stats.get(topic)
+        if stats is None:
+            stats = self._stats[topic] = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0,
+                                          'invalidations': 0, 'load_seconds': 0.0}
+        return stats
+
+    def get(self, topic, loader, key=None):
+        """Cached value for (topic, key), calling loader() to fill it on a miss"""
+        entry_key = (topic, key)
+        now = time.monotonic()
+        with self._lock:
+            stats = self._topic_stats(topic)
+            entry = self._entries.get(entry_key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(entry_key)
+                    stats['hits'] += 1
+                    return entry[1]
+                del self._entries[entry_key]
+                stats['expired'] += 1
+            stats['misses'] += 1
+            generation = self._generations.get(topic, 0)
+
+        started = time.perf_counter()
+        value = loader()
+        loaded = time.perf_counter()
+
+        with self._lock:
+            stats['load_seconds'] += loaded - started
+            if self._generations.get(topic, 0) == generation:
+                self._entries[entry_key] = (time.monotonic() + self.ttl, value)
+                self._entries.move_to_end(entry_key)
+                while len(self._entries) > self.max_entries:
+                    evicted_key, _ = self._entries.popitem(last=False)
+                    self._topic_stats(evicted_key[0])['evicted'] += 1
+        return value
+
+    def invalidate_local(self, *topics):
+        """Drop this worker's entries for `topics` (all topics when none are given)"""
+        with self._lock:
+            topics = topics or set(TOPICS) | set(self._generations) | {k[0] for k in self._entries}
+            for topic in topics:
+                self._generations[topic] = self._generations.get(topic, 0) + 1
+                self._topic_stats(topic)['invalidations'] += 1
+                for entry_key in [k for k in self._entries if k[0] == topic]:
+                    del self._entries[entry_key]
+
+    def invalidate(self, cur, *topics):
+        """Drop `topics` here now and in every worker when cur's transaction commits"""
+        self.invalidate_local(*topics)
+        notify(cur, *topics)
+
+    def stats(self):
+        with self._lock:
+            topics = {}
+            for topic, stats in self._stats.items():
+                lookups = stats['hits'] + stats['misses']
+                topics[topic] = dict(stats, load_seconds=round(stats['load_seconds'], 4),
+                                     hit_rate=round(stats['hits'] / lookups, 4) if lookups else None)
+            return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                    'ttl_seconds': self.ttl, 'topics': topics}
+
+class Listener:
+    """Background thread that applies other workers' invalidations to a ReferenceCache
+
+    `connect()` must return a new DB-API connection; it is kept in autocommit mode
+    and used only for LISTEN.
+    """
+    def __init__(self, connect, reference_cache, channel=CHANNEL):
+        self.connect = connect
+        self.cache = reference_cache
+        self.channel = channel
+        self.notifications = 0
+        self.connections = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _listen(self):
+        conn = self.connect()
+        conn.autocommit = True
+        conn.cursor().execute(f"LISTEN {self.channel}")
+        return conn
+
+    def _run(self):
+        conn = None
+        delay = 1
+        while not self._stop.is_set():
+            try:
+                if conn is None:
+                    conn = self._listen()
+                    if self.connections:
+                        # Anything could have changed while we were not listening
+                        self.cache.invalidate_local()
+                    self.connections += 1
+                    delay = 1
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                topics = set()
+                while conn.notifies:
+                    topics.add(conn.notifies.pop(0).payload)
+                if topics:
+                    self.notifications += len(topics)
+                    self.cache.invalidate_local(*topics)
+            except Exception as e:
+                print(f"Cache listener error: {type(e).__name__}: {e}")
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                conn = None
+                self._stop.wait(delay)
+                delay = min(delay * 2, 60)
+        if conn is not None:
+            conn.close()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='cache-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
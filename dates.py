@@ -0,0 +1,103 @@
+"""Date helpers shared by the AOA Library app, emails and reminders.
+
+psycopg2 already returns DATE columns as datetime.date, so code should pass those
+through untouched. The helpers here accept dates, datetimes or 'YYYY-MM-DD'
+strings (form input, JSON built in SQL), parse strings once and memoize the
+formatted result: a reminder run or a long table formats the same few hundred
+distinct dates over and over.
+
+    python dates.py --bench 20000   # time formatting, the reminder loop and the assignments table
+"""
+import sys
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+import dbutil
+
+DISPLAY_FORMAT = '%B %d, %Y'
+
+@lru_cache(maxsize=4096)
+def _parse(text):
+    try:
+        return datetime.strptime(text[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+def to_date(value):
+    """date for a date, datetime or 'YYYY-MM-DD...' string; None if it cannot be read"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, str):
+        return _parse(value.strip())
+    return None
+
+@lru_cache(maxsize=4096)
+def _format(value, format):
+    if isinstance(value, str):
+        parsed = _parse(value.strip())
+        # Unreadable strings are shown as they are
+        return parsed.strftime(format) if parsed else value
+    return value.strftime(format)
+
+def format_date(value, format='%Y-%m-%d'):
+    """Format a date, datetime or 'YYYY-MM-DD' string ('' for None)"""
+    if value is None:
+        return ''
+    if isinstance(value, (date, str)):
+        return _format(value, format)
+    return str(value)
+
+def display(value):
+    """Long form used in emails, e.g. 'October 17, 2026'"""
+    return format_date(value, DISPLAY_FORMAT)
+
+def _uncached_display(value):
+    # What format_date_for_display did before this module: parse and format on every call
+    if isinstance(value, date):
+        return value.strftime(DISPLAY_FORMAT)
+    return datetime.strptime(value, '%Y-%m-%d').strftime(DISPLAY_FORMAT)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] != ['--bench']:
+        print(__doc__)
+        return 0
+    count = int(argv[1]) if len(argv) > 1 else 20000
+    today = date.today()
+    # A realistic spread: a year of issue dates, so each distinct date repeats many times
+    issued = [today - timedelta(days=i % 365) for i in range(count)]
+    issued_text = [d.isoformat() for d in issued]
+
+    print(f"Date formatting, {count} values:")
+    dbutil.timed("parse + format each string (old)", lambda: [_uncached_display(v) for v in issued_text], count, unit='item')
+    dbutil.timed("dates.display on strings (memoized)", lambda: [display(v) for v in issued_text], count, unit='item')
+    dbutil.timed("dates.display on native dates (memoized)", lambda: [display(v) for v in issued], count, unit='item')
+
+    import emails
+    loans = [{'student_name': f"Student {i}", 'title': f"Title {i % 500}", 'book_id': f"B{i}",
+              'issue': issued[i], 'exp': issued[i] + timedelta(days=14), 'days_overdue': i % 30}
+             for i in range(count)]
+    print(f"Reminder loop, {count} overdue emails (HTML + text):")
+    dbutil.timed("render_many('overdue') with native dates", lambda: emails.render_many('overdue', loans, library_name='AOA Library'), count, unit='item')
+
+    # Render the page template on its own (importing app would start its background threads);
+    # the layout only needs url_for and request.path
+    import os
+    from types import SimpleNamespace
+    from jinja2 import Environment, FileSystemLoader
+    env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')),
+                      autoescape=True)
+    env.globals.update(url_for=lambda endpoint, **values: f"/{endpoint}",
+                       request=SimpleNamespace(path='/operations/assignments'))
+    template = env.get_template('view_assignments.html')
+    rows = [{'student': f"Student {i}", 'title': f"Title {i % 500}", 'book_id': f"B{i}",
+             'date_assigned': issued[i], 'return_date': issued[i] + timedelta(days=14),
+             'assigned_by': 'Librarian'} for i in range(count)]
+    print(f"Assignments table, {count} rows:")
+    dbutil.timed("render view_assignments.html", lambda: template.render(assignments=rows), count, unit='item')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
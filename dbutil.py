@@ -0,0 +1,14 @@
+"""Small helpers shared by the AOA Library's database modules and command-line tools."""
+import time
+
+def dict_rows(cur):
+    """The cursor's remaining rows as dicts, from a RealDictCursor or a plain tuple cursor"""
+    names = [col[0] for col in cur.description]
+    return [dict(row) if isinstance(row, dict) else dict(zip(names, row)) for row in cur.fetchall()]
+
+def timed(label, func, count, unit='call'):
+    """Run func() once and print its time in total and per `unit` (func does `count` of them)"""
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<48} {elapsed:8.3f}s  ({elapsed / count * 1e6:6.1f} us per {unit})")
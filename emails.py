@@ -0,0 +1,130 @@
+"""Email templates for the AOA Library.
+
+The Jinja templates in templates/email/ share one layout (base.html) and a few
+macros (_macros.html). They are compiled once when this module is imported and
+reused for every message. render() returns (subject, html, text); the plain-text
+alternative is derived from the HTML, so templates only need to be written once.
+
+Preview or time the templates with sample data:
+
+    python emails.py overdue          # print subject, HTML and text for one template
+    python emails.py --bench 1000     # render 1000 overdue reminders
+"""
+import os
+import re
+import sys
+import time
+from datetime import date, datetime, timedelta
+from html import unescape
+
+from jinja2 import Environment, FileSystemLoader
+
+import dates
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'email')
+TEMPLATES = ('assignment', 'return', 'due_tomorrow', 'overdue', 'digest', 'test')
+
+# auto_reload=False: templates never change while the app runs, so skip the mtime checks
+env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=True, auto_reload=False,
+                  trim_blocks=True, lstrip_blocks=True)
+env.filters['display_date'] = dates.display
+
+_compiled = {name: env.get_template(f"{name}.html") for name in TEMPLATES}
+
+_BLOCK_TAGS = {'p', 'div', 'h1', 'h2', 'h3', 'h4', 'ul', 'ol', 'li', 'table', 'tr', 'br', 'hr'}
+_HIDDEN = re.compile(r'<(style|head|title)\b.*?</\1\s*>', re.S | re.I)
+_TAG = re.compile(r'<(/?)([a-zA-Z0-9]+)[^>]*>')
+_BREAK = '\x00'
+
+def _tag_text(match):
+    closing, tag = match.group(1), match.group(2).lower()
+    if tag not in _BLOCK_TAGS:
+        return ''
+    if tag == 'li' and not closing:
+        return _BREAK + '- '
+    if tag == 'hr':
+        return _BREAK + '---' + _BREAK
+    return _BREAK
+
+def html_to_text(html):
+    """Plain-text alternative for an HTML email: one paragraph per block element, '- ' for list items"""
+    text = unescape(_TAG.sub(_tag_text, _HIDDEN.sub('', html)))
+    paragraphs = []
+    for line in text.split(_BREAK):
+        line = ' '.join(line.split())
+        if not line or line == '-':
+            continue
+        # Keep list items together, separate everything else by a blank line
+        if paragraphs and not (line.startswith('- ') and paragraphs[-1].startswith('- ')):
+            paragraphs.append('')
+        paragraphs.append(line)
+    return '\n'.join(paragraphs) + '\n'
+
+def _subject(template, context):
+    return ' '.join(''.join(template.blocks['subject'](template.new_context(context))).split())
+
+def render(name, **context):
+    """Render one email; returns (subject, html, text)"""
+    template = _compiled[name]
+    html = template.render(context)
+    return _subject(template, context), html, html_to_text(html)
+
+def render_many(name, contexts, **shared):
+    """Render one email per context with `shared` values (e.g. library_name) in every one; returns a list of (subject, html, text)"""
+    template = _compiled[name]
+    results = []
+    for context in contexts:
+        merged = {**shared, **context}
+        html = template.render(merged)
+        results.append((_subject(template, merged), html, html_to_text(html)))
+    return results
+
+def sample_context(name):
+    """Representative data for previews and benchmarks"""
+    today = date.today()
+    books = [{'title': 'Things Fall Apart', 'book_id': 'LIT-0001', 'issue': today - timedelta(days=14)},
+             {'title': 'Calculus & Analysis', 'book_id': 'MATH-0042', 'issue': today - timedelta(days=7)}]
+    common = {'library_name': 'AOA Library', 'student_name': 'Kesha Wanjare'}
+    if name == 'assignment':
+        return dict(common, books=books, borrowed_date=today, return_date=today + timedelta(days=14),
+                    assigned_by='Librarian')
+    if name == 'return':
+        return dict(common, books=books, return_date=today, returned_by='Librarian')
+    if name == 'digest':
+        overdue = [{'title': 'Things Fall Apart', 'book_id': 'LIT-0001', 'issue': today - timedelta(days=21),
+                    'exp': today - timedelta(days=7), 'days_overdue': 7}]
+        due = [{'title': 'Calculus & Analysis', 'book_id': 'MATH-0042', 'issue': today - timedelta(days=13),
+                'exp': today + timedelta(days=1)}]
+        return dict(common, overdue=overdue, due_tomorrow=due)
+    if name == 'test':
+        return {'library_name': 'AOA Library', 'sent_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+    loan = dict(common, title='Things Fall Apart', book_id='LIT-0001', issue=today - timedelta(days=21),
+                exp=today + timedelta(days=1))
+    if name == 'overdue':
+        loan.update(exp=today - timedelta(days=3), days_overdue=3)
+    return loan
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['--bench']:
+        count = int(argv[1]) if len(argv) > 1 else 1000
+        context = sample_context('overdue')
+        library_name = context.pop('library_name')
+        contexts = [dict(context, student_name=f"Student {i}", book_id=f"B{i}") for i in range(count)]
+        started = time.perf_counter()
+        render_many('overdue', contexts, library_name=library_name)
+        elapsed = time.perf_counter() - started
+        print(f"Rendered {count} overdue reminders (HTML + text) in {elapsed:.3f}s "
+              f"({elapsed / count * 1e6:.0f} us each)")
+        return 0
+    names = argv or list(TEMPLATES)
+    for name in names:
+        if name not in _compiled:
+            print(f"Unknown template {name!r}; choose from {', '.join(TEMPLATES)}")
+            return 2
+        subject, html, text = render(name, **sample_context(name))
+        print(f"===== {name}: {subject}\n{html}\n----- text\n{text}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,632 @@
+"""Bulk import and restore for the AOA Library database.
+
+Loads the SQL dump produced by /admin/download-database, book catalog CSVs and
+student roster CSVs through COPY FROM STDIN and set-based INSERTs:
+
+    python importer.py dump aoa_library_backup.sql[.gz] [--workers N] [--no-end-marker]
+    python importer.py catalog books.csv [--workers N]
+    python importer.py roster students.csv [--workers N]
+
+Catalog CSV columns: subject, title, author, and optional book_id, copies and
+id_prefix (copies get IDs like <id_prefix>0001; without a prefix the ID is the serial).
+Roster CSV columns: name (or first_name + second_name), email, and optional userid.
+
+With --workers 1 (the default, and always from the web endpoint) the whole import
+is one transaction. With more workers, large files are split across a process
+pool: CSV chunks are staged in parallel and merged in one final transaction,
+and dump tables are loaded concurrently (one table per worker) into a scratch
+schema, then swapped in by one final transaction. Either way a failed import
+leaves the database as it was.
+
+A dump must end with the DUMP_END_MARKER line the download writes last, so one
+cut short by an error or a dropped connection is refused instead of restored
+partially. --no-end-marker accepts dumps downloaded before the marker existed.
+"""
+import csv
+import gzip
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cache
+import inventory
+import migrations
+import returns
+import versions
+
+CATALOG_STAGING_COLUMNS = ('subject', 'title', 'author', 'book_id', 'id_prefix')
+ROSTER_STAGING_COLUMNS = ('name', 'email', 'userid')
+
+# Last line of every dump /admin/download-database writes; its absence means the download was cut short
+DUMP_END_MARKER = '-- END OF DUMP'
+
+# Scratch schema a parallel dump restore loads into before swapping the tables into public
+RESTORE_SCHEMA = 'restore_staging'
+
+# Generated book IDs are prefix + zero-padded counter, e.g. MATH-0042 (BOOK_ID_PAD=4)
+BOOK_ID_PAD = int(os.getenv('BOOK_ID_PAD', '4'))
+
+def _print_progress(message):
+    print(f"[import] {message}", flush=True)
+
+def _copy_field(val):
+    """Render a value in PostgreSQL COPY text format"""
+    if val is None:
+        return "\\N"
+    return (str(val).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+def _copy_rows(cur, table, columns, rows):
+    """COPY an iterable of tuples into table in one round trip"""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(_copy_field(v) for v in row) + "\n")
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buf)
+
+def _normalize_header(header):
+    return [h.strip().lower().replace(' ', '_') for h in header]
+
+def _catalog_rows(header, records):
+    """Validate catalog records and expand the copies column into one row per copy"""
+    missing = {'subject', 'title', 'author'} - set(header)
+    if missing:
+        raise ValueError(f"Catalog CSV is missing column(s): {', '.join(sorted(missing))}")
+    for line_no, record in records:
+        row = dict(zip(header, (v.strip() for v in record)))
+        if not any(row.values()):
+            continue
+        subject, title, author = row.get('subject'), row.get('title'), row.get('author')
+        if not (subject and title and author):
+            raise ValueError(f"Line {line_no}: subject, title and author are required")
+        book_id = row.get('book_id') or None
+        try:
+            copies = int(row.get('copies') or 1)
+            if copies < 1:
+                raise ValueError()
+        except ValueError:
+            raise ValueError(f"Line {line_no}: copies must be a positive integer")
+        if book_id and copies != 1:
+            raise ValueError(f"Line {line_no}: provide book_id only when copies = 1")
+        id_prefix = row.get('id_prefix') or None
+        for _ in range(copies):
+            yield (subject, title, author, book_id, id_prefix)
+
+def _roster_rows(header, records):
+    """Validate roster records into (name, email, userid) rows"""
+    if 'name' not in header and 'first_name' not in header:
+        raise ValueError("Roster CSV needs a name or first_name column")
+    if 'email' not in header:
+        raise ValueError("Roster CSV is missing column: email")
+    for line_no, record in records:
+        row = dict(zip(header, (v.strip() for v in record)))
+        if not any(row.values()):
+            continue
+        name = row.get('name') or ' '.join(
+            part for part in (row.get('first_name'), row.get('second_name') or row.get('last_name')) if part)
+        email = row.get('email')
+        if not name:
+            raise ValueError(f"Line {line_no}: name is required")
+        if not email or '@' not in email or '.' not in email:
+            raise ValueError(f"Line {line_no}: a valid email address is required")
+        userid = row.get('userid') or None
+        if userid and not userid.isdigit():
+            raise ValueError(f"Line {line_no}: userid must be numeric")
+        yield (name, email, userid)
+
+CSV_KINDS = {
+    'catalog': (_catalog_rows, CATALOG_STAGING_COLUMNS),
+    'roster': (_roster_rows, ROSTER_STAGING_COLUMNS),
+}
+
+def _create_staging_table(cur, name, columns, temporary=True):
+    kind = "TEMP" if temporary else "UNLOGGED"
+    cur.execute(f"DROP TABLE IF EXISTS {name}")
+    cur.execute(f"CREATE {kind} TABLE {name} (ord BIGSERIAL, "
+                + ", ".join(f"{c} TEXT" for c in columns) + ")")
+
+def _book_insert_sql(source):
+    """INSERT ... SELECT that creates every copy in `source` with generated serials and book IDs
+
+    `source` must yield (ord, subject, title, author, book_id, id_prefix). Copies without a
+    book_id get id_prefix + zero-padded counter continuing after the highest existing ID with
+    that prefix, or their serial when there is no prefix. Takes BOOK_ID_PAD as its parameter.
+    """
+    return f"""
+        WITH src AS ({source}),
+        bases AS (
+            SELECT p.id_prefix,
+                   COALESCE(MAX(CAST(SUBSTRING(b.book_id FROM LENGTH(p.id_prefix) + 1) AS BIGINT)), 0) AS base
+            FROM (SELECT DISTINCT id_prefix FROM src WHERE id_prefix IS NOT NULL AND book_id IS NULL) p
+            -- Every ID starting with the prefix, as a range on idx_book_book_id_prefix
+            LEFT JOIN Book b ON b.book_id COLLATE "C" >= p.id_prefix
+                AND b.book_id COLLATE "C" < p.id_prefix || chr(1114111)
+                AND SUBSTRING(b.book_id FROM LENGTH(p.id_prefix) + 1) ~ '^[0-9]{{1,18}}$'
+            GROUP BY p.id_prefix
+        ),
+        numbered AS (
+            SELECT src.ord, src.subject, src.title, src.author, src.book_id, src.id_prefix,
+                   -- By name: a restored Book's serial default uses it, but no longer owns it
+                   nextval('book_serial_seq') AS serial,
+                   bases.base + ROW_NUMBER() OVER (PARTITION BY src.id_prefix, src.book_id IS NULL ORDER BY src.ord) AS counter
+            FROM src LEFT JOIN bases ON bases.id_prefix = src.id_prefix
+        )
+        INSERT INTO Book(subject, title, author, serial, book_id)
+        SELECT subject, title, author, serial,
+               COALESCE(book_id, CASE WHEN id_prefix IS NULL THEN CAST(serial AS TEXT)
+                   ELSE id_prefix || LPAD(CAST(counter AS TEXT), GREATEST(%s, LENGTH(CAST(counter AS TEXT))), '0') END)
+        FROM numbered
+        ORDER BY ord
+        RETURNING book_id
+    """
+
+def _lock_id_prefixes(cur, prefixes):
+    # Serialize concurrent accessions that continue the same prefix counter
+    for prefix in sorted(set(p for p in prefixes if p)):
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"book_id_prefix:{prefix}",))
+
+def insert_books(cur, books, pad=None):
+    """Create every (subject, title, author, book_id, id_prefix) copy in one statement; returns new book IDs
+
+    Runs in the caller's transaction. Raises ValueError for book IDs that already exist.
+    """
+    books = list(books)
+    if not books:
+        return []
+    custom_ids = [b[3] for b in books if b[3]]
+    if len(custom_ids) != len(set(custom_ids)):
+        raise ValueError("The same Book ID appears more than once")
+    if custom_ids:
+        cur.execute("SELECT book_id FROM Book WHERE book_id = ANY(%s) LIMIT 5", (custom_ids,))
+        existing = [row[0] if isinstance(row, tuple) else row['book_id'] for row in cur.fetchall()]
+        if existing:
+            raise ValueError(f"Book ID(s) already exist: {', '.join(existing)}")
+    _lock_id_prefixes(cur, [b[4] for b in books])
+    columns = list(zip(*books))
+    cur.execute(_book_insert_sql("""
+        SELECT ord, subject, title, author, book_id, id_prefix
+        FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::text[])
+             WITH ORDINALITY AS t(subject, title, author, book_id, id_prefix, ord)
+    """), [list(c) for c in columns] + [BOOK_ID_PAD if pad is None else pad])
+    book_ids = [row[0] if isinstance(row, tuple) else row['book_id'] for row in cur.fetchall()]
+    inventory.books_added(cur, book_ids)
+    cache.notify(cur, 'titles')
+    return book_ids
+
+def _merge_catalog(cur, staging):
+    """Move staged books into Book, generating serials and book IDs in one statement"""
+    cur.execute(f"""
+        (SELECT book_id FROM {staging} WHERE book_id IS NOT NULL GROUP BY book_id HAVING COUNT(*) > 1)
+        UNION
+        (SELECT s.book_id FROM {staging} s JOIN Book b ON b.book_id = s.book_id)
+        LIMIT 5
+    """)
+    duplicates = [row[0] for row in cur.fetchall()]
+    if duplicates:
+        raise ValueError(f"Book ID(s) already exist or repeat in the file: {', '.join(duplicates)}")
+    cur.execute(f"SELECT DISTINCT id_prefix FROM {staging} WHERE id_prefix IS NOT NULL")
+    _lock_id_prefixes(cur, [row[0] for row in cur.fetchall()])
+    cur.execute(_book_insert_sql(f"SELECT ord, subject, title, author, book_id, id_prefix FROM {staging}"),
+                (BOOK_ID_PAD,))
+    inserted = cur.rowcount
+    # One recount is cheaper than upserting a bulk load copy by copy
+    inventory.rebuild(cur)
+    cache.notify(cur, 'titles')
+    return inserted
+
+def _merge_roster(cur, staging):
+    """Move staged students into Login, numbering rows without a userid after MAX(userid)"""
+    # Same numbering scheme as add_student; block concurrent inserts while we allocate
+    cur.execute("LOCK TABLE Login IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute(f"""
+        (SELECT userid FROM {staging} WHERE userid IS NOT NULL GROUP BY userid HAVING COUNT(*) > 1)
+        UNION
+        (SELECT s.userid FROM {staging} s JOIN Login l ON l.userid = s.userid)
+        LIMIT 5
+    """)
+    duplicates = [row[0] for row in cur.fetchall()]
+    if duplicates:
+        raise ValueError(f"User ID(s) already exist or repeat in the file: {', '.join(duplicates)}")
+    cur.execute(f"""
+        SELECT GREATEST(
+            (SELECT COALESCE(MAX(CAST(userid AS INTEGER)), 0) FROM Login),
+            (SELECT COALESCE(MAX(CAST(userid AS INTEGER)), 0) FROM {staging})
+        )
+    """)
+    base = cur.fetchone()[0]
+    cur.execute(f"""
+        INSERT INTO Login(name, userid, email)
+        SELECT name,
+               COALESCE(userid, CAST(%s + ROW_NUMBER() OVER (PARTITION BY userid IS NULL ORDER BY ord) AS TEXT)),
+               email
+        FROM {staging}
+        ORDER BY ord
+    """, (base,))
+    inserted = cur.rowcount
+    cache.notify(cur, 'students')
+    return inserted
+
+MERGERS = {'catalog': _merge_catalog, 'roster': _merge_roster}
+
+def import_csv(conn, kind, fileobj, progress=_print_progress):
+    """Import a catalog or roster CSV (text file object) in a single transaction"""
+    parse, columns = CSV_KINDS[kind]
+    started = time.monotonic()
+    reader = csv.reader(fileobj)
+    try:
+        header = _normalize_header(next(reader))
+    except StopIteration:
+        raise ValueError("CSV file is empty")
+    rows = list(parse(header, ((reader.line_num, record) for record in reader)))
+    progress(f"{kind}: parsed {len(rows)} row(s)")
+    cur = conn.cursor()
+    try:
+        staging = f"import_{kind}"
+        _create_staging_table(cur, staging, columns)
+        _copy_rows(cur, staging, columns, rows)
+        inserted = MERGERS[kind](cur, staging)
+        cur.execute(f"DROP TABLE {staging}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    elapsed = time.monotonic() - started
+    progress(f"{kind}: inserted {inserted} row(s) in {elapsed:.2f}s")
+    return {'kind': kind, 'rows': {'book' if kind == 'catalog' else 'login': inserted},
+            'seconds': round(elapsed, 3)}
+
+def _split_lines(path, parts):
+    """Split a file into up to `parts` byte ranges on line boundaries (after the header line)"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.readline()
+        start = f.tell()
+        bounds = [start]
+        for i in range(1, parts):
+            f.seek(max(start, size * i // parts))
+            f.readline()
+            if f.tell() > bounds[-1] and f.tell() < size:
+                bounds.append(f.tell())
+        bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+def _stage_csv_chunk(kind, path, header, start, end, staging):
+    """Worker: parse one byte range of the CSV and COPY it into the shared staging table"""
+    parse, columns = CSV_KINDS[kind]
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8-sig')
+    # Line numbers are relative to the chunk in parallel mode
+    records = enumerate(csv.reader(io.StringIO(text)), start=1)
+    rows = list(parse(header, records))
+    conn = migrations.connect()
+    try:
+        _copy_rows(conn.cursor(), staging, columns, rows)
+        conn.commit()
+    finally:
+        conn.close()
+    return len(rows)
+
+def import_csv_parallel(conn, kind, path, workers, progress=_print_progress):
+    """Stage a large CSV across a process pool, then merge it in one transaction"""
+    _, columns = CSV_KINDS[kind]
+    started = time.monotonic()
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        header = _normalize_header(next(csv.reader(f)))
+    staging = f"import_{kind}_staging"
+    cur = conn.cursor()
+    _create_staging_table(cur, staging, columns, temporary=False)
+    conn.commit()
+    try:
+        chunks = _split_lines(path, workers)
+        staged = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_stage_csv_chunk, kind, path, header, start, end, staging)
+                       for start, end in chunks]
+            for future in futures:
+                staged += future.result()
+                progress(f"{kind}: staged {staged} row(s)")
+        inserted = MERGERS[kind](cur, staging)
+        cur.execute(f"DROP TABLE {staging}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        cur.execute(f"DROP TABLE IF EXISTS {staging}")
+        conn.commit()
+        raise
+    elapsed = time.monotonic() - started
+    progress(f"{kind}: inserted {inserted} row(s) with {workers} worker(s) in {elapsed:.2f}s")
+    return {'kind': kind, 'rows': {'book' if kind == 'catalog' else 'login': inserted},
+            'seconds': round(elapsed, 3)}
+
+class _RangeReader:
+    """File-like view of a byte range, handed to copy_expert without loading it into memory"""
+    def __init__(self, fileobj, start, end):
+        self.fileobj = fileobj
+        self.remaining = end - start
+        fileobj.seek(start)
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        data = self.fileobj.readline(self.remaining if size is None or size < 0 else min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+def _classify_statement(text):
+    """Return (phase, table) for a dump statement: 'schema', 'data' or 'post'"""
+    words = text.split(None, 4)
+    upper = [w.upper() for w in words]
+    if upper[:2] == ['INSERT', 'INTO'] and len(words) > 2:
+        return 'data', words[2].lower()
+    if upper[:1] == ['COPY'] and len(words) > 1:
+        return 'data', words[1].lower()
+    if upper[:1] == ['SELECT'] and 'SETVAL(' in text.upper():
+        return 'post', None
+    if upper[:2] == ['CREATE', 'INDEX'] or upper[:3] == ['CREATE', 'UNIQUE', 'INDEX'] or upper[:1] == ['ALTER']:
+        return 'post', None
+    return 'schema', None
+
+def scan_dump(fileobj, require_end=True):
+    """Index a dump into segments without loading it: (phase, table, start, end, copy_sql)
+
+    Raises ValueError for a truncated dump, including (with require_end) one
+    whose last statement is not followed by DUMP_END_MARKER.
+    """
+    segments = []
+    ended = False
+    offset = 0
+    stmt_start = None
+    stmt_head = b''
+    quotes = 0
+    copy = None  # (table, copy_sql, data_start) while inside a COPY block
+    fileobj.seek(0)
+    for line in iter(fileobj.readline, b''):
+        if copy is not None:
+            if line.rstrip(b'\r\n') == b'\\.':
+                table, copy_sql, data_start = copy
+                segments.append(('data', table, data_start, offset, copy_sql))
+                copy = None
+            offset += len(line)
+            continue
+        if stmt_start is None:
+            stripped = line.strip()
+            if not stripped or stripped.startswith(b'--'):
+                ended = ended or stripped == DUMP_END_MARKER.encode()
+                offset += len(line)
+                continue
+            stmt_start, stmt_head, quotes, ended = offset, b'', 0, False
+        if len(stmt_head) < 200:
+            stmt_head += line[:200]
+        quotes += line.count(b"'")
+        offset += len(line)
+        if quotes % 2 == 0 and line.rstrip().endswith(b';'):
+            head = stmt_head.decode('utf-8', 'replace')
+            phase, table = _classify_statement(head)
+            if head.lstrip().upper().startswith('COPY '):
+                fileobj.seek(stmt_start)
+                copy_sql = fileobj.read(offset - stmt_start).decode('utf-8').strip().rstrip(';')
+                fileobj.seek(offset)
+                copy = (table, copy_sql, offset)
+            else:
+                segments.append((phase, table, stmt_start, offset, None))
+            stmt_start = None
+    if copy is not None or stmt_start is not None:
+        raise ValueError("Dump file is truncated (unterminated statement or COPY block)")
+    if require_end and not ended:
+        raise ValueError(f"Dump file is truncated (no '{DUMP_END_MARKER}' line after the last statement); "
+                         "download it again, or restore a dump made before end markers with "
+                         "importer.py --no-end-marker")
+    return segments
+
+def _apply_segment(cur, fileobj, segment):
+    _, _, start, end, copy_sql = segment
+    if copy_sql:
+        cur.copy_expert(copy_sql, _RangeReader(fileobj, start, end))
+    else:
+        fileobj.seek(start)
+        cur.execute(fileobj.read(end - start).decode('utf-8'))
+
+def _finish_restore(cur):
+    # Dumps from older versions carry no TitleInventory, and a restored one may not match its Book rows
+    inventory.create_table(cur)
+    inventory.rebuild(cur)
+    # Everything may have changed; drop every worker's cached reference data
+    cache.notify(cur)
+    # Dumps carry BookReturnDetail unpartitioned (and old ones a BookReturn to fold in)
+    returns.install(cur)
+    # The dump dropped and recreated the tables (and their version triggers), and may carry an old TableVersion
+    versions.install(cur)
+
+def restore_dump(conn, fileobj, progress=_print_progress, require_end=True):
+    """Restore an SQL dump (binary, seekable file object) in a single transaction"""
+    started = time.monotonic()
+    segments = scan_dump(fileobj, require_end)
+    progress(f"dump: {len(segments)} statement(s)/COPY block(s) to apply")
+    cur = conn.cursor()
+    report = {}
+    try:
+        for segment in segments:
+            _apply_segment(cur, fileobj, segment)
+            phase, table = segment[0], segment[1]
+            if phase == 'data':
+                report[table] = report.get(table, 0) + max(cur.rowcount, 0)
+                progress(f"dump: {table} {report[table]} row(s)")
+        _finish_restore(cur)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    elapsed = time.monotonic() - started
+    progress(f"dump: restored {sum(report.values())} row(s) in {elapsed:.2f}s")
+    return {'kind': 'dump', 'rows': report, 'seconds': round(elapsed, 3)}
+
+def _restore_table_segments(path, segments):
+    """Worker: load every data segment of one table into its staging copy in its own transaction"""
+    conn = migrations.connect()
+    rows = 0
+    try:
+        cur = conn.cursor()
+        cur.execute(f"SET search_path TO {RESTORE_SCHEMA}")
+        with open(path, 'rb') as f:
+            for segment in segments:
+                _apply_segment(cur, f, segment)
+                rows += max(cur.rowcount, 0)
+        conn.commit()
+    finally:
+        conn.close()
+    return segments[0][1], rows
+
+def _swap_in_staged(cur):
+    """Replace the public tables and sequences with the staged ones (in the caller's transaction)"""
+    cur.execute("""
+        SELECT relname, relkind FROM pg_class
+        WHERE relnamespace = %s::regnamespace AND relkind IN ('r', 'S')
+        ORDER BY relkind, relname
+    """, (RESTORE_SCHEMA,))
+    staged = cur.fetchall()
+    for name, kind in staged:
+        if kind == 'r':
+            cur.execute(f"DROP TABLE IF EXISTS public.{name} CASCADE")
+            cur.execute(f"ALTER TABLE {RESTORE_SCHEMA}.{name} SET SCHEMA public")
+    # Sequences the dump created (serial columns keep theirs through the table move)
+    for name, kind in staged:
+        if kind == 'S':
+            cur.execute("SELECT 1 FROM pg_class WHERE relnamespace = %s::regnamespace AND relname = %s",
+                        (RESTORE_SCHEMA, name))
+            if cur.fetchone():
+                cur.execute(f"DROP SEQUENCE IF EXISTS public.{name}")
+                cur.execute(f"ALTER SEQUENCE {RESTORE_SCHEMA}.{name} SET SCHEMA public")
+    cur.execute(f"DROP SCHEMA {RESTORE_SCHEMA} CASCADE")
+
+def restore_dump_parallel(conn, path, workers, progress=_print_progress, require_end=True):
+    """Restore a dump with table data loaded concurrently, swapped in as a single transaction
+
+    The dump's tables are created in the RESTORE_SCHEMA scratch schema and loaded
+    there by the workers; one final transaction then drops the public tables,
+    moves the loaded ones into public and adds the indexes and keys. A worker
+    failure drops the scratch schema and leaves the database as it was.
+    """
+    started = time.monotonic()
+    cur = conn.cursor()
+    with open(path, 'rb') as f:
+        segments = scan_dump(f, require_end)
+        cur.execute(f"DROP SCHEMA IF EXISTS {RESTORE_SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {RESTORE_SCHEMA}")
+        # Only the scratch schema on the path, so the dump's DROP TABLE statements cannot reach public
+        cur.execute(f"SET LOCAL search_path TO {RESTORE_SCHEMA}")
+        by_table = {}
+        for segment in segments:
+            if segment[0] == 'schema':
+                _apply_segment(cur, f, segment)
+            elif segment[0] == 'data':
+                by_table.setdefault(segment[1], []).append(segment)
+        conn.commit()
+    progress(f"dump: schema staged, loading {len(by_table)} table(s) with {workers} worker(s)")
+
+    report = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_restore_table_segments, path, table_segments)
+                       for table_segments in by_table.values()]
+            for future in futures:
+                table, rows = future.result()
+                report[table] = rows
+                progress(f"dump: {table} {rows} row(s) staged")
+
+        progress("dump: swapping the staged tables in")
+        with open(path, 'rb') as f:
+            _swap_in_staged(cur)
+            for segment in segments:
+                if segment[0] == 'post':
+                    _apply_segment(cur, f, segment)
+            _finish_restore(cur)
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        cur.execute(f"DROP SCHEMA IF EXISTS {RESTORE_SCHEMA} CASCADE")
+        conn.commit()
+        raise
+    elapsed = time.monotonic() - started
+    progress(f"dump: restored {sum(report.values())} row(s) in {elapsed:.2f}s")
+    return {'kind': 'dump', 'rows': report, 'seconds': round(elapsed, 3)}
+
+def is_gzip(fileobj):
+    pos = fileobj.tell()
+    magic = fileobj.read(2)
+    fileobj.seek(pos)
+    return magic == b'\x1f\x8b'
+
+def spool_upload(stream):
+    """Copy an uploaded (possibly gzip-compressed) stream to a seekable temporary file"""
+    spooled = tempfile.TemporaryFile()
+    source = gzip.GzipFile(fileobj=stream) if is_gzip(stream) else stream
+    shutil.copyfileobj(source, spooled, 1024 * 1024)
+    spooled.seek(0)
+    return spooled
+
+def import_file(conn, kind, fileobj, progress=_print_progress, require_end=True):
+    """Import an uploaded file (binary, seekable) of the given kind in a single transaction"""
+    if kind == 'dump':
+        return restore_dump(conn, fileobj, progress, require_end)
+    if kind in CSV_KINDS:
+        text = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+        try:
+            return import_csv(conn, kind, text, progress)
+        finally:
+            text.detach()
+    raise ValueError(f"Unknown import type: {kind}")
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    workers = 1
+    require_end = '--no-end-marker' not in argv
+    argv = [arg for arg in argv if arg != '--no-end-marker']
+    if '--workers' in argv:
+        i = argv.index('--workers')
+        workers = int(argv[i + 1])
+        argv = argv[:i] + argv[i + 2:]
+    if len(argv) != 2 or argv[0] not in ('dump', 'catalog', 'roster'):
+        print(__doc__)
+        return 2
+    kind, path = argv
+
+    cleanup = None
+    if path.endswith('.gz'):
+        with open(path, 'rb') as f:
+            spooled = spool_upload(f)
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.import') as tmp:
+            shutil.copyfileobj(spooled, tmp)
+        path = cleanup = tmp.name
+
+    conn = migrations.connect()
+    try:
+        if workers > 1 and kind == 'dump':
+            report = restore_dump_parallel(conn, path, workers, require_end=require_end)
+        elif workers > 1:
+            report = import_csv_parallel(conn, kind, path, workers)
+        else:
+            with open(path, 'rb') as f:
+                report = import_file(conn, kind, f, require_end=require_end)
+    finally:
+        conn.close()
+        if cleanup:
+            os.unlink(cleanup)
+    print(f"Imported {report['rows']} in {report['seconds']}s")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""Per-title inventory summary for the AOA Library catalog.
+
+TitleInventory keeps one row per (title, subject, author) with the number of
+copies and how many of them are on loan. Every write path that adds, deletes or
+edits books, or assigns or returns copies, adjusts it in the same transaction,
+so title listings and availability checks read a few index entries instead of
+counting Book against BookIssue.
+
+If it ever drifts (manual SQL, an old dump), check and rebuild it:
+
+    python inventory.py            # report drifted rows
+    python inventory.py --rebuild  # recompute the whole table
+"""
+import sys
+
+# Fresh per-title counts straight from Book/BookIssue (the source of truth)
+_COUNTS_SQL = """
+    SELECT COALESCE(b.title, '') AS title, COALESCE(b.subject, '') AS subject,
+           COALESCE(b.author, '') AS author, COUNT(*) AS total,
+           COUNT(*) FILTER (WHERE EXISTS (SELECT 1 FROM BookIssue i WHERE i.book_id = b.book_id)) AS on_loan
+    FROM Book b
+    {where}
+    GROUP BY 1, 2, 3
+"""
+
+# Groups are upserted in key order so concurrent writers lock rows in the same order
+_APPLY_SQL = """
+    INSERT INTO TitleInventory AS t (title, subject, author, total, on_loan)
+    SELECT title, subject, author, {total}, {on_loan}
+    FROM ({counts}) d
+    ORDER BY 1, 2, 3
+    ON CONFLICT (title, subject, author) DO UPDATE
+    SET total = t.total + EXCLUDED.total, on_loan = t.on_loan + EXCLUDED.on_loan
+"""
+
+def create_table(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS TitleInventory(
+            title TEXT NOT NULL, subject TEXT NOT NULL, author TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0, on_loan INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (title, subject, author)
+        )
+    ''')
+
+def _apply(cur, where, params, total, on_loan):
+    cur.execute(_APPLY_SQL.format(total=total, on_loan=on_loan, counts=_COUNTS_SQL.format(where=where)), params)
+
+def books_added(cur, book_ids):
+    """Count copies that were just inserted into Book"""
+    if book_ids:
+        _apply(cur, "WHERE b.book_id = ANY(%s)", (list(book_ids),), "total", "on_loan")
+
+def books_removed(cur, where, params=()):
+    """Uncount the copies matching `where` (on Book b); call before deleting or editing them"""
+    _apply(cur, f"WHERE {where}", params, "-total", "-on_loan")
+    cur.execute("DELETE FROM TitleInventory WHERE total <= 0")
+
+def books_restored(cur, where, params=()):
+    """Count the copies matching `where` (on Book b) again after editing them"""
+    _apply(cur, f"WHERE {where}", params, "total", "on_loan")
+
+def loans_changed(cur, book_ids, sign):
+    """Move copies onto (sign=1) or off (sign=-1) loan; call after inserting or deleting their BookIssue rows"""
+    if book_ids:
+        _apply(cur, "WHERE b.book_id = ANY(%s)", (list(book_ids),), "0", f"{int(sign)} * total")
+
+def rebuild(cur):
+    """Recompute the whole inventory from Book and BookIssue; returns the number of title rows"""
+    # Blocks concurrent adjustments until commit so none are lost or double counted
+    cur.execute("LOCK TABLE TitleInventory IN EXCLUSIVE MODE")
+    cur.execute("DELETE FROM TitleInventory")
+    cur.execute("INSERT INTO TitleInventory(title, subject, author, total, on_loan) "
+                + _COUNTS_SQL.format(where=""))
+    return cur.rowcount
+
+def check(cur, limit=50):
+    """Compare the inventory with a fresh count; returns up to `limit` drifted rows (empty when consistent)"""
+    cur.execute(f"""
+        SELECT title, subject, author,
+               s.total AS stored_total, s.on_loan AS stored_on_loan,
+               f.total AS actual_total, f.on_loan AS actual_on_loan
+        FROM TitleInventory s
+        FULL JOIN ({_COUNTS_SQL.format(where="")}) f USING (title, subject, author)
+        WHERE s.total IS DISTINCT FROM f.total OR s.on_loan IS DISTINCT FROM f.on_loan
+        ORDER BY title, subject, author
+        LIMIT %s
+    """, (limit,))
+    names = [col[0] for col in cur.description]
+    return [dict(row) if isinstance(row, dict) else dict(zip(names, row)) for row in cur.fetchall()]
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    import migrations
+    conn = migrations.connect()
+    try:
+        cur = conn.cursor()
+        if '--rebuild' in argv:
+            rows = rebuild(cur)
+            # View Titles reads TitleInventory but is validated against book's counter
+            import versions
+            versions.bump(cur, 'book')
+            conn.commit()
+            print(f"TitleInventory rebuilt: {rows} title row(s)")
+            return 0
+        drift = check(cur)
+        conn.rollback()
+        if not drift:
+            print("TitleInventory is consistent")
+            return 0
+        print(f"TitleInventory has drifted ({len(drift)} row(s) shown); run with --rebuild")
+        for row in drift:
+            print(f"  {row['title']!r} / {row['subject']!r} / {row['author']!r}: "
+                  f"stored {row['stored_total']}/{row['stored_on_loan']}, "
+                  f"actual {row['actual_total']}/{row['actual_on_loan']}")
+        return 1
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+"""Request instrumentation for the AOA Library: query counts, database and render time, slow queries.
+
+CursorWrapper.execute reports every statement to the current request's
+RequestStats (how many ran, the time spent in the database, the slowest ones with
+their parameters), and Flask's template signals time rendering. When the request
+finishes, Registry adds its numbers to per-endpoint counters, which
+/admin/metrics serves in Prometheus text format, and logs:
+
+- slow statements (SLOW_QUERY_MS and over), with their parameters;
+- N+1 patterns: one statement run N_PLUS_ONE_THRESHOLD or more times in a request,
+  the signature of a loop that queries once per book or student;
+- slow requests (SLOW_REQUEST_MS and over), with their slowest statements.
+
+The recent findings are also kept for /admin/slow-queries. With SERVER_TIMING=1
+every response carries a Server-Timing header (db, render, total) that browser
+dev tools show next to the request.
+
+Counters are per worker process, like the pool and cache stats.
+"""
+import hmac
+import os
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from functools import lru_cache
+
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '200'))
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '1000'))
+N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', '10'))
+SERVER_TIMING = os.getenv('SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+# Lets a Prometheus scraper, which cannot log in, read /admin/metrics
+TOKEN = os.getenv('METRICS_TOKEN', '')
+# Findings kept for /admin/slow-queries, and slowest statements kept per request
+LOG_SIZE = int(os.getenv('SLOW_QUERY_LOG_SIZE', '100'))
+SLOWEST_PER_REQUEST = 3
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACE = re.compile(r'\s+')
+
+@lru_cache(maxsize=1024)
+def statement_shape(query):
+    """The statement with literals replaced by ? and whitespace collapsed, so per-item queries group together"""
+    return _SPACE.sub(' ', _LITERALS.sub('?', query)).strip()
+
+def _short(value, limit=300):
+    text = repr(value)
+    return text if len(text) <= limit else text[:limit] + '...'
+
+def token_matches(authorization):
+    """Whether an Authorization header carries METRICS_TOKEN (never when no token is configured)"""
+    return bool(TOKEN) and hmac.compare_digest(authorization or '', f"Bearer {TOKEN}")
+
+class RequestStats:
+    """What one request spent: statements run, database time, render time"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self._render_started = None
+        # shape -> [executions, seconds]
+        self.statements = {}
+        # (seconds, shape, params), slowest first
+        self.slowest = []
+        self.slow = []
+
+    def record_query(self, query, params, seconds):
+        self.queries += 1
+        self.db_seconds += seconds
+        shape = statement_shape(query)
+        totals = self.statements.get(shape)
+        if totals is None:
+            self.statements[shape] = [1, seconds]
+        else:
+            totals[0] += 1
+            totals[1] += seconds
+        if len(self.slowest) < SLOWEST_PER_REQUEST or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, shape, _short(params)))
+            self.slowest.sort(key=lambda item: -item[0])
+            del self.slowest[SLOWEST_PER_REQUEST:]
+        if seconds * 1000 >= SLOW_QUERY_MS:
+            self.slow.append((seconds, shape, _short(params)))
+
+    def render_started(self):
+        self._render_started = time.perf_counter()
+
+    def render_finished(self):
+        if self._render_started is not None:
+            self.render_seconds += time.perf_counter() - self._render_started
+            self._render_started = None
+
+    def repeated(self):
+        """(shape, executions, seconds) for statements run N_PLUS_ONE_THRESHOLD or more times"""
+        return [(shape, count, seconds) for shape, (count, seconds) in self.statements.items()
+                if count >= N_PLUS_ONE_THRESHOLD]
+
+    def server_timing(self, total):
+        return (f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries", '
+                f'render;dur={self.render_seconds * 1000:.1f}, total;dur={total * 1000:.1f}')
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Registry:
+    """Thread-safe per-endpoint counters and the recent slow-query and N+1 log"""
+    def __init__(self, log_size=LOG_SIZE):
+        self._lock = threading.Lock()
+        # (endpoint, method, status) -> requests
+        self._responses = {}
+        # endpoint -> totals and duration histogram
+        self._endpoints = {}
+        self._slow_log = deque(maxlen=log_size)
+        self._n_plus_one_log = deque(maxlen=log_size)
+
+    def _endpoint(self, endpoint):
+        totals = self._endpoints.get(endpoint)
+        if totals is None:
+            totals = self._endpoints[endpoint] = {
+                'requests': 0, 'seconds': 0.0, 'buckets': [0] * (len(DURATION_BUCKETS) + 1),
+                'queries': 0, 'db_seconds': 0.0, 'render_seconds': 0.0, 'slow_queries': 0, 'n_plus_one': 0,
+            }
+        return totals
+
+    def finish(self, stats, endpoint, method, path, status):
+        """Record a finished request; returns its total time in seconds"""
+        total = time.perf_counter() - stats.started
+        endpoint = endpoint or 'unmatched'
+        repeated = stats.repeated()
+        at = datetime.now().isoformat(timespec='seconds')
+        bucket = next((i for i, bound in enumerate(DURATION_BUCKETS) if total <= bound), len(DURATION_BUCKETS))
+        with self._lock:
+            key = (endpoint, method, status)
+            self._responses[key] = self._responses.get(key, 0) + 1
+            totals = self._endpoint(endpoint)
+            totals['requests'] += 1
+            totals['seconds'] += total
+            totals['buckets'][bucket] += 1
+            totals['queries'] += stats.queries
+            totals['db_seconds'] += stats.db_seconds
+            totals['render_seconds'] += stats.render_seconds
+            totals['slow_queries'] += len(stats.slow)
+            totals['n_plus_one'] += len(repeated)
+            for seconds, shape, params in stats.slow:
+                self._slow_log.append({'at': at, 'endpoint': endpoint, 'path': path, 'ms': round(seconds * 1000, 1),
+                                       'statement': shape, 'params': params})
+            for shape, count, seconds in repeated:
+                self._n_plus_one_log.append({'at': at, 'endpoint': endpoint, 'path': path, 'executions': count,
+                                             'ms': round(seconds * 1000, 1), 'statement': shape})
+
+        for seconds, shape, params in stats.slow:
+            print(f"[slow-query] {seconds * 1000:.1f}ms {method} {path}: {shape} {params}")
+        for shape, count, seconds in repeated:
+            print(f"[n+1] {method} {path} ran one statement {count}x ({seconds * 1000:.1f}ms): {shape}")
+        if total * 1000 >= SLOW_REQUEST_MS:
+            slowest = '; '.join(f"{seconds * 1000:.1f}ms {shape} {params}" for seconds, shape, params in stats.slowest)
+            print(f"[slow-request] {total * 1000:.0f}ms {method} {path}: {stats.queries} queries, "
+                  f"db {stats.db_seconds * 1000:.1f}ms, render {stats.render_seconds * 1000:.1f}ms; slowest: {slowest}")
+        return total
+
+    def findings(self):
+        """Recent slow statements and N+1 patterns, newest first"""
+        with self._lock:
+            return {
+                'slow_queries': list(reversed(self._slow_log)),
+                'n_plus_one': list(reversed(self._n_plus_one_log)),
+                'thresholds': {'slow_query_ms': SLOW_QUERY_MS, 'slow_request_ms': SLOW_REQUEST_MS,
+                               'n_plus_one_executions': N_PLUS_ONE_THRESHOLD},
+            }
+
+    def prometheus(self, gauges=None):
+        """Prometheus text exposition of the counters plus `gauges` ({name: (help, value)})"""
+        with self._lock:
+            responses = sorted(self._responses.items())
+            endpoints = sorted((name, dict(totals, buckets=list(totals['buckets'])))
+                               for name, totals in self._endpoints.items())
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        family('library_http_requests_total', 'counter', 'Requests handled by this worker.')
+        for (endpoint, method, status), count in responses:
+            lines.append(f'library_http_requests_total{{endpoint="{_label(endpoint)}",method="{method}",'
+                         f'status="{status}"}} {count}')
+
+        family('library_http_request_duration_seconds', 'histogram', 'Time from request start to response.')
+        for endpoint, totals in endpoints:
+            label = f'endpoint="{_label(endpoint)}"'
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS + ('+Inf',), totals['buckets']):
+                cumulative += count
+                lines.append(f'library_http_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'library_http_request_duration_seconds_sum{{{label}}} {totals["seconds"]:.6f}')
+            lines.append(f'library_http_request_duration_seconds_count{{{label}}} {totals["requests"]}')
+
+        for name, field, help_text in (
+            ('library_db_queries_total', 'queries', 'SQL statements run by requests.'),
+            ('library_db_query_seconds_total', 'db_seconds', 'Time requests spent executing SQL.'),
+            ('library_render_seconds_total', 'render_seconds', 'Time requests spent rendering templates.'),
+            ('library_slow_queries_total', 'slow_queries', f'Statements taking {SLOW_QUERY_MS:g}ms or more.'),
+            ('library_n_plus_one_total', 'n_plus_one',
+             f'Statements run {N_PLUS_ONE_THRESHOLD} or more times in one request.'),
+        ):
+            family(name, 'counter', help_text)
+            for endpoint, totals in endpoints:
+                value = totals[field]
+                value = f"{value:.6f}" if isinstance(value, float) else value
+                lines.append(f'{name}{{endpoint="{_label(endpoint)}"}} {value}')
+
+        for name, (help_text, value) in (gauges or {}).items():
+            family(name, 'gauge', help_text)
+            lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
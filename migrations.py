@@ -0,0 +1,634 @@
+"""Versioned schema migrations for the AOA Library database.
+
+Run once per deploy, before the web workers start:
+
+    python migrations.py            # apply pending migrations
+    python migrations.py --status   # show applied and pending migrations
+
+Each step runs in its own transaction together with its schema_version row, and
+the whole run holds a PostgreSQL advisory lock so concurrent deploys never race.
+"""
+import os
+import sys
+import urllib.parse as urlparse
+from datetime import date, datetime, timedelta
+
+import psycopg2
+import pytz
+
+# Arbitrary application-wide key for pg_advisory_lock (must not clash with other locks)
+MIGRATION_LOCK_ID = 7_420_001
+
+def _today():
+    """Today's date in the library's timezone (SCHEDULER_TIMEZONE), for backfills that stop at today"""
+    return datetime.now(pytz.timezone(os.getenv('SCHEDULER_TIMEZONE', 'Africa/Nairobi'))).date()
+
+def _has_column(cur, table_name, column_name):
+    """Check if a column exists in a table (case-insensitive)"""
+    # PostgreSQL stores table names in lowercase unless quoted
+    cur.execute("""
+        SELECT 1
+        FROM information_schema.columns
+        WHERE LOWER(table_name) = LOWER(%s) AND LOWER(column_name) = LOWER(%s)
+    """, (table_name, column_name))
+    return cur.fetchone() is not None
+
+def _create_base_tables(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS Login(
+            name TEXT, userid TEXT, password INTEGER,
+            branch TEXT, mobile INTEGER, email TEXT
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS Book(
+            subject TEXT, title TEXT, author TEXT,
+            serial SERIAL PRIMARY KEY, book_id TEXT UNIQUE
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS BookIssue(
+            stdid TEXT, serial TEXT, issue DATE, exp DATE,
+            book_id TEXT, assigned_by TEXT
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS BookReturn(
+            stdid TEXT, title TEXT, copies INTEGER,
+            issue DATE, returned DATE
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS BookReturnDetail(
+            stdid TEXT, title TEXT, book_id TEXT,
+            issue DATE, returned DATE, returned_by TEXT
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS DeletedLogin(
+            name TEXT, userid TEXT, deleted DATE
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS DeletedBook(
+            subject TEXT, title TEXT, author TEXT,
+            book_id TEXT, deleted DATE
+        )
+    ''')
+
+def _sync_book_serial_sequence(cur):
+    # After a data migration the SERIAL sequence can lag behind MAX(serial)
+    cur.execute("SELECT pg_get_serial_sequence('book', 'serial')")
+    sequence = cur.fetchone()[0]
+    if sequence:
+        cur.execute("SELECT setval(%s, COALESCE((SELECT MAX(serial) FROM Book), 0) + 1, false)", (sequence,))
+
+def _add_book_book_id(cur):
+    if _has_column(cur, 'Book', 'book_id'):
+        return
+    cur.execute("ALTER TABLE Book ADD COLUMN book_id TEXT")
+    cur.execute("UPDATE Book SET book_id = CAST(serial AS TEXT) WHERE book_id IS NULL OR book_id = ''")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_book_book_id ON Book(book_id)")
+
+def _add_bookissue_book_id(cur):
+    if _has_column(cur, 'BookIssue', 'book_id'):
+        return
+    cur.execute("ALTER TABLE BookIssue ADD COLUMN book_id TEXT")
+    cur.execute("UPDATE BookIssue SET book_id = (SELECT b.book_id FROM Book b WHERE CAST(b.serial AS TEXT) = BookIssue.serial) WHERE book_id IS NULL")
+
+def _add_bookissue_assigned_by(cur):
+    cur.execute("ALTER TABLE BookIssue ADD COLUMN IF NOT EXISTS assigned_by TEXT")
+
+def _add_login_email(cur):
+    cur.execute("ALTER TABLE Login ADD COLUMN IF NOT EXISTS email TEXT")
+
+def _add_bookreturndetail_returned_by(cur):
+    cur.execute("ALTER TABLE BookReturnDetail ADD COLUMN IF NOT EXISTS returned_by TEXT")
+
+def _type_bookissue_serial_and_index_joins(cur):
+    # BookIssue.serial was TEXT, so every join needed CAST(i.serial AS INTEGER), which
+    # prevents index use. Make it a real integer key referencing Book.serial.
+    cur.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE LOWER(table_name) = 'bookissue' AND LOWER(column_name) = 'serial'
+    """)
+    if cur.fetchone()[0] != 'integer':
+        cur.execute("ALTER TABLE BookIssue ALTER COLUMN serial TYPE INTEGER USING NULLIF(TRIM(serial), '')::INTEGER")
+    # NOT VALID: enforce for new rows without failing on historical orphans
+    cur.execute("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'fk_bookissue_serial') THEN
+                ALTER TABLE BookIssue ADD CONSTRAINT fk_bookissue_serial
+                    FOREIGN KEY (serial) REFERENCES Book(serial) NOT VALID;
+            END IF;
+        END $$
+    """)
+    # Availability checks and returns look up loans by copy
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookissue_book_id ON BookIssue(book_id)")
+    # Per-student loans joined to Book (return form, /api/get_student_books, /api/get_titles)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookissue_stdid_serial ON BookIssue(stdid, serial)")
+    # Due-tomorrow and overdue reminder scans
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookissue_exp ON BookIssue(exp)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookissue_serial ON BookIssue(serial)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_login_userid ON Login(userid)")
+    # Covers "WHERE title = ? ORDER BY book_id" with an index-only scan
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_book_title_book_id ON Book(title, book_id)")
+    cur.execute("ANALYZE Book")
+    cur.execute("ANALYZE BookIssue")
+    cur.execute("ANALYZE Login")
+
+def _index_catalog_sort_keys(cur):
+    # Keyset pagination of /api/books sorts on COALESCE(column, '') with book_id as tie-breaker
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_book_title_key ON Book((COALESCE(title, '')), book_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_book_subject_key ON Book((COALESCE(subject, '')), book_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_book_author_key ON Book((COALESCE(author, '')), book_id)")
+    cur.execute("ANALYZE Book")
+
+def _add_trigram_search_indexes(cur):
+    # pg_trgm powers ranked, typo-tolerant autocomplete; the app falls back to ILIKE without it
+    cur.execute("SAVEPOINT trgm")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT trgm")
+        print(f"WARNING: pg_trgm extension unavailable ({e.pgerror or e}); search will use ILIKE only")
+        return
+    cur.execute("RELEASE SAVEPOINT trgm")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_login_name_trgm ON Login USING gin (name gin_trgm_ops)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_book_title_trgm ON Book USING gin (title gin_trgm_ops)")
+
+def _create_title_inventory(cur):
+    # Maintained per-title counts; see inventory.py for the write paths that keep it in sync
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS TitleInventory(
+            title TEXT NOT NULL, subject TEXT NOT NULL, author TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0, on_loan INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (title, subject, author)
+        )
+    ''')
+    cur.execute("DELETE FROM TitleInventory")
+    cur.execute("""
+        INSERT INTO TitleInventory(title, subject, author, total, on_loan)
+        SELECT COALESCE(b.title, ''), COALESCE(b.subject, ''), COALESCE(b.author, ''), COUNT(*),
+               COUNT(*) FILTER (WHERE EXISTS (SELECT 1 FROM BookIssue i WHERE i.book_id = b.book_id))
+        FROM Book b
+        GROUP BY 1, 2, 3
+    """)
+    cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+    if cur.fetchone():
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_titleinventory_title_trgm ON TitleInventory USING gin (title gin_trgm_ops)")
+    cur.execute("ANALYZE TitleInventory")
+
+def _unique_loan_per_copy(cur):
+    # A copy can be on loan only once; checkout relies on this for INSERT ... ON CONFLICT
+    cur.execute("""
+        SELECT book_id FROM BookIssue WHERE book_id IS NOT NULL
+        GROUP BY book_id HAVING COUNT(*) > 1 ORDER BY book_id LIMIT 10
+    """)
+    duplicates = [row[0] for row in cur.fetchall()]
+    if duplicates:
+        raise RuntimeError("Copies on loan more than once (return the extra loans, then re-run): "
+                           + ", ".join(duplicates))
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_bookissue_book_id ON BookIssue(book_id) WHERE book_id IS NOT NULL")
+    # The unique index serves every lookup the plain one did
+    cur.execute("DROP INDEX IF EXISTS idx_bookissue_book_id")
+
+def _create_email_outbox(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS EmailOutbox(
+            id BIGSERIAL PRIMARY KEY,
+            to_email TEXT NOT NULL, subject TEXT NOT NULL, body TEXT NOT NULL,
+            dedupe_key TEXT UNIQUE,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            locked_until TIMESTAMPTZ,
+            last_error TEXT, provider_id TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(), sent_at TIMESTAMPTZ
+        )
+    ''')
+    # Only unfinished rows are ever scanned by the dispatcher
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_emailoutbox_due ON EmailOutbox(next_attempt_at) "
+                "WHERE status IN ('pending', 'sending')")
+
+def _add_emailoutbox_text_body(cur):
+    cur.execute("ALTER TABLE EmailOutbox ADD COLUMN IF NOT EXISTS text_body TEXT")
+
+def _create_scheduler_tables(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS ScheduledJob(
+            name TEXT PRIMARY KEY,
+            schedule TEXT NOT NULL,
+            next_run_at TIMESTAMPTZ NOT NULL,
+            last_run_at TIMESTAMPTZ, last_status TEXT, last_duration_ms INTEGER
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS JobRun(
+            id BIGSERIAL PRIMARY KEY,
+            job TEXT NOT NULL,
+            scheduled_for TIMESTAMPTZ NOT NULL,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ, duration_ms INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            error TEXT, worker TEXT
+        )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobrun_job_started ON JobRun(job, started_at DESC)")
+
+def _create_reminder_ledger(cur):
+    # tier 0 is the "due tomorrow" reminder, N > 0 the N-days-overdue tier
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS ReminderLedger(
+            stdid TEXT NOT NULL, serial INTEGER NOT NULL, issue DATE NOT NULL, exp DATE NOT NULL,
+            tier INTEGER NOT NULL,
+            sent_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (stdid, serial, issue, exp, tier)
+        )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reminderledger_sent_at ON ReminderLedger(sent_at)")
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS ReminderState(
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            processed_through DATE
+        )
+    ''')
+    # Until now every overdue loan was re-emailed daily: count each loan's current tier
+    # (the highest of the tiers this step shipped with it has reached by yesterday) as sent
+    tiers = (1, 3, 7, 14)
+    as_of = _today() - timedelta(days=1)
+    cur.execute("""
+        INSERT INTO ReminderLedger(stdid, serial, issue, exp, tier)
+        SELECT i.stdid, i.serial, i.issue, i.exp, MAX(t.tier)
+        FROM BookIssue i
+        JOIN unnest(%s::int[]) AS t(tier) ON i.exp <= CAST(%s AS DATE) - t.tier
+        WHERE i.stdid IS NOT NULL AND i.serial IS NOT NULL AND i.issue IS NOT NULL
+        GROUP BY i.stdid, i.serial, i.issue, i.exp
+        ON CONFLICT DO NOTHING
+    """, (list(tiers), as_of))
+    cur.execute("""
+        INSERT INTO ReminderState(id, processed_through) VALUES (TRUE, %s)
+        ON CONFLICT (id) DO UPDATE SET processed_through = GREATEST(ReminderState.processed_through, EXCLUDED.processed_through)
+    """, (as_of,))
+
+# Names that were hard-coded in app.py before the list moved to the database
+_INITIAL_STAFF = ['Afsa', 'Alex', 'Angella', 'Arun', 'Claudine', 'Emmy', 'Gaidi', 'George',
+                  'Guylain', 'Innocent I', 'Innocent M', 'Jeanette', 'Josue', 'Kelly', 'Linda',
+                  'Marie Josee', 'Nepo', 'Obed', 'Sindi', 'Wendy', 'Jacky']
+
+def _create_staff(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS Staff(name TEXT PRIMARY KEY)")
+    cur.execute("INSERT INTO Staff(name) SELECT unnest(%s::text[]) ON CONFLICT DO NOTHING", (_INITIAL_STAFF,))
+
+def _track_table_versions(cur, tables):
+    """The version counters and triggers as steps 18-20 installed them, on `tables`"""
+    cur.execute("CREATE SEQUENCE IF NOT EXISTS table_version_seq")
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS TableVersion(
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL,
+            changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE TableVersion SET version = nextval('table_version_seq'), changed_at = now()
+            WHERE name = TG_TABLE_NAME;
+            RETURN NULL;
+        END
+        $$
+    ''')
+    for table in tables:
+        cur.execute(f"DROP TRIGGER IF EXISTS {table}_version ON {table}")
+        cur.execute(f"CREATE TRIGGER {table}_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table} "
+                    "FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()")
+    cur.execute("""
+        INSERT INTO TableVersion(name, version)
+        SELECT name, nextval('table_version_seq') FROM unnest(%s::text[]) AS t(name)
+        ON CONFLICT (name) DO UPDATE SET version = EXCLUDED.version, changed_at = now()
+    """, (list(tables),))
+    cur.execute("DELETE FROM TableVersion WHERE name <> ALL(%s)", (list(tables),))
+
+def _create_table_versions(cur):
+    _track_table_versions(cur, ('book', 'bookissue', 'login', 'bookreturn', 'bookreturndetail',
+                                'deletedbook', 'deletedlogin'))
+
+def _add_return_partitions(cur, years):
+    """Yearly BookReturnDetail partitions for `years`, moving their rows out of the default partition"""
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('bookreturndetail')
+    """)
+    existing = {row[0] for row in cur.fetchall()}
+    for year in sorted(set(int(y) for y in years)):
+        name = f"bookreturndetail_y{year}"
+        if name in existing:
+            continue
+        start, end = date(year, 1, 1), date(year + 1, 1, 1)
+        cur.execute(f"CREATE TABLE {name} (LIKE BookReturnDetail INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        cur.execute(f"""
+            WITH moved AS (
+                DELETE FROM bookreturndetail_default WHERE returned >= %s AND returned < %s RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """, (start, end))
+        cur.execute(f"ALTER TABLE BookReturnDetail ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+                    (start, end))
+
+def _return_years(cur, table):
+    cur.execute(f"SELECT DISTINCT CAST(EXTRACT(YEAR FROM returned) AS INTEGER) FROM {table} WHERE returned IS NOT NULL")
+    return [row[0] for row in cur.fetchall()]
+
+def _partition_returns_ledger(cur):
+    cur.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('bookreturndetail')")
+    if cur.fetchone() is None:
+        cur.execute("ALTER TABLE BookReturnDetail RENAME TO bookreturndetail_unpartitioned")
+        cur.execute('''
+            CREATE TABLE BookReturnDetail(
+                stdid TEXT NOT NULL, title TEXT NOT NULL, book_id TEXT,
+                issue DATE, returned DATE NOT NULL, returned_by TEXT,
+                copies INTEGER NOT NULL DEFAULT 1
+            ) PARTITION BY RANGE (returned)
+        ''')
+        cur.execute("CREATE TABLE bookreturndetail_default PARTITION OF BookReturnDetail DEFAULT")
+        _add_return_partitions(cur, _return_years(cur, 'bookreturndetail_unpartitioned'))
+        # Rows written before these columns were enforced: a missing return date falls back to the issue date
+        cur.execute("""
+            INSERT INTO BookReturnDetail(stdid, title, book_id, issue, returned, returned_by, copies)
+            SELECT COALESCE(stdid, ''), COALESCE(title, ''), book_id, issue,
+                   COALESCE(returned, issue, CURRENT_DATE), returned_by, 1
+            FROM bookreturndetail_unpartitioned
+        """)
+        cur.execute("DROP TABLE bookreturndetail_unpartitioned")
+    cur.execute("SELECT to_regclass('bookreturn') IS NOT NULL")
+    if cur.fetchone()[0]:
+        _add_return_partitions(cur, _return_years(cur, 'BookReturn'))
+        # Summaries the old returns page showed because no detail rows covered them
+        cur.execute("""
+            INSERT INTO BookReturnDetail(stdid, title, book_id, issue, returned, returned_by, copies)
+            SELECT COALESCE(r.stdid, ''), COALESCE(r.title, ''), NULL, r.issue,
+                   COALESCE(r.returned, r.issue, CURRENT_DATE), NULL, COALESCE(r.copies, 1)
+            FROM BookReturn r
+            WHERE NOT EXISTS (
+                SELECT 1 FROM BookReturnDetail d
+                WHERE d.stdid = COALESCE(r.stdid, '') AND d.title = COALESCE(r.title, '')
+                  AND d.returned = r.returned AND d.book_id IS NOT NULL
+            )
+        """)
+        print(f"Returns ledger: folded {cur.rowcount} legacy BookReturn row(s) into BookReturnDetail")
+        cur.execute("DROP TABLE BookReturn")
+    year = date.today().year
+    _add_return_partitions(cur, [year, year + 1])
+    # Newest-first pages walk the first index backwards; a student's history uses the second
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookreturndetail_returned ON BookReturnDetail(returned, stdid, title)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookreturndetail_stdid ON BookReturnDetail(stdid, returned)")
+    # BookReturnDetail is a new table now and BookReturn is gone: re-point the version triggers
+    _track_table_versions(cur, ('book', 'bookissue', 'login', 'bookreturndetail', 'deletedbook', 'deletedlogin'))
+
+def _create_analytics_rollups(cur):
+    # Returns keep the loan's due date and lending staff member from now on
+    cur.execute("ALTER TABLE BookReturnDetail ADD COLUMN IF NOT EXISTS exp DATE")
+    cur.execute("ALTER TABLE BookReturnDetail ADD COLUMN IF NOT EXISTS assigned_by TEXT")
+    # The rollup finds loans by the day they started
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookreturndetail_issue ON BookReturnDetail(issue)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookissue_issue ON BookIssue(issue)")
+    # timed_returns: returns with an issue date (loan_days covers those);
+    # dated_returns: returns with a due date (overdue_returns is out of those)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS CirculationDaily(
+            day DATE NOT NULL, title TEXT NOT NULL, subject TEXT NOT NULL, staff TEXT NOT NULL,
+            checkouts INTEGER NOT NULL DEFAULT 0,
+            returns INTEGER NOT NULL DEFAULT 0,
+            timed_returns INTEGER NOT NULL DEFAULT 0,
+            loan_days BIGINT NOT NULL DEFAULT 0,
+            dated_returns INTEGER NOT NULL DEFAULT 0,
+            overdue_returns INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, title, subject, staff)
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS LoanSnapshot(
+            day DATE NOT NULL, subject TEXT NOT NULL, staff TEXT NOT NULL,
+            open_loans INTEGER NOT NULL, overdue_loans INTEGER NOT NULL,
+            PRIMARY KEY (day, subject, staff)
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS AnalyticsState(
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            processed_through DATE,
+            refreshed_at TIMESTAMPTZ
+        )
+    ''')
+    # Backfill the rollups from every loan and return on record
+    today = _today()
+    cur.execute("DELETE FROM CirculationDaily")
+    cur.execute("""
+        INSERT INTO CirculationDaily(day, title, subject, staff, checkouts, returns, timed_returns,
+                                     loan_days, dated_returns, overdue_returns)
+        SELECT day, title, subject, staff, SUM(checkouts), SUM(returns), SUM(timed_returns),
+               SUM(loan_days), SUM(dated_returns), SUM(overdue_returns)
+        FROM (
+            SELECT i.issue AS day, COALESCE(b.title, '') AS title, COALESCE(b.subject, 'Unknown') AS subject,
+                   COALESCE(i.assigned_by, '') AS staff, 1 AS checkouts, 0 AS returns, 0 AS timed_returns,
+                   0 AS loan_days, 0 AS dated_returns, 0 AS overdue_returns
+            FROM BookIssue i LEFT JOIN Book b ON b.serial = i.serial
+            WHERE i.issue <= %(today)s
+            UNION ALL
+            SELECT d.issue, d.title, COALESCE(b.subject, 'Unknown'), COALESCE(d.assigned_by, ''),
+                   d.copies, 0, 0, 0, 0, 0
+            FROM BookReturnDetail d LEFT JOIN Book b ON b.book_id = d.book_id
+            WHERE d.issue <= %(today)s
+            UNION ALL
+            SELECT d.returned, d.title, COALESCE(b.subject, 'Unknown'), COALESCE(d.assigned_by, ''),
+                   0, d.copies,
+                   CASE WHEN d.issue IS NOT NULL THEN d.copies ELSE 0 END,
+                   CASE WHEN d.issue IS NOT NULL THEN GREATEST(d.returned - d.issue, 0) * d.copies ELSE 0 END,
+                   CASE WHEN d.exp IS NOT NULL THEN d.copies ELSE 0 END,
+                   CASE WHEN d.returned > d.exp THEN d.copies ELSE 0 END
+            FROM BookReturnDetail d LEFT JOIN Book b ON b.book_id = d.book_id
+            WHERE d.returned <= %(today)s
+        ) events
+        GROUP BY day, title, subject, staff
+    """, {'today': today})
+    cur.execute("DELETE FROM LoanSnapshot WHERE day = %s", (today,))
+    cur.execute("""
+        INSERT INTO LoanSnapshot(day, subject, staff, open_loans, overdue_loans)
+        SELECT %s, COALESCE(b.subject, 'Unknown'), COALESCE(i.assigned_by, ''),
+               COUNT(*), COUNT(*) FILTER (WHERE i.exp < %s)
+        FROM BookIssue i LEFT JOIN Book b ON b.serial = i.serial
+        GROUP BY 2, 3
+    """, (today, today))
+    cur.execute("""
+        INSERT INTO AnalyticsState(id, processed_through, refreshed_at) VALUES (TRUE, %s, now())
+        ON CONFLICT (id) DO UPDATE SET processed_through = EXCLUDED.processed_through, refreshed_at = now()
+    """, (today,))
+    _track_table_versions(cur, ('book', 'bookissue', 'login', 'bookreturndetail', 'deletedbook', 'deletedlogin',
+                                'circulationdaily', 'loansnapshot'))
+
+def _count_table_versions_per_session(cur):
+    # One counter row per table and session: the trigger's UPDATE of a shared row made
+    # concurrent writers to a table queue behind each other until commit
+    cur.execute("DROP TABLE IF EXISTS TableVersion")
+    cur.execute('''
+        CREATE TABLE TableVersion(
+            name TEXT NOT NULL,
+            backend INTEGER NOT NULL,
+            version BIGINT NOT NULL,
+            changed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (name, backend)
+        )
+    ''')
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO TableVersion AS v (name, backend, version, changed_at)
+            VALUES (TG_TABLE_NAME, pg_backend_pid(), 1, now())
+            ON CONFLICT (name, backend) DO UPDATE SET version = v.version + 1, changed_at = now();
+            RETURN NULL;
+        END
+        $$
+    ''')
+    # Base rows start past every version the old layout handed out
+    cur.execute("""
+        INSERT INTO TableVersion(name, backend, version)
+        SELECT name, 0, nextval('table_version_seq') << 32 FROM unnest(%s::text[]) AS t(name)
+    """, (['book', 'bookissue', 'login', 'bookreturndetail', 'deletedbook', 'deletedlogin',
+           'circulationdaily', 'loansnapshot'],))
+
+def _index_book_id_prefixes(cur):
+    # Byte-wise order, so "book_id under a prefix" is a range scan whatever the database collation
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_book_book_id_prefix ON Book((book_id COLLATE "C"))')
+
+# Ordered list of (version, description, step). Never renumber or edit an applied step;
+# append a new one instead. Steps must be safe on databases created before versioning.
+# Each step carries its own SQL, frozen as it first shipped: helpers in other modules
+# describe today's schema and change with it, so a step must not call them.
+MIGRATIONS = [
+    (1, 'Create base tables', _create_base_tables),
+    (2, 'Sync book_serial_seq with MAX(Book.serial)', _sync_book_serial_sequence),
+    (3, 'Add Book.book_id', _add_book_book_id),
+    (4, 'Add BookIssue.book_id', _add_bookissue_book_id),
+    (5, 'Add BookIssue.assigned_by', _add_bookissue_assigned_by),
+    (6, 'Add Login.email', _add_login_email),
+    (7, 'Add BookReturnDetail.returned_by', _add_bookreturndetail_returned_by),
+    (8, 'Make BookIssue.serial an integer key and index loan joins', _type_bookissue_serial_and_index_joins),
+    (9, 'Index catalog sort keys for keyset pagination', _index_catalog_sort_keys),
+    (10, 'Add pg_trgm search indexes on student names and book titles', _add_trigram_search_indexes),
+    (11, 'Add TitleInventory per-title copy counts', _create_title_inventory),
+    (12, 'Allow one loan per copy (unique BookIssue.book_id)', _unique_loan_per_copy),
+    (13, 'Add EmailOutbox for durable email delivery', _create_email_outbox),
+    (14, 'Add EmailOutbox.text_body plain-text alternative', _add_emailoutbox_text_body),
+    (15, 'Add ScheduledJob and JobRun for the leader-elected scheduler', _create_scheduler_tables),
+    (16, 'Add ReminderLedger and watermark for incremental reminders', _create_reminder_ledger),
+    (17, 'Add Staff table (staff list was hard-coded)', _create_staff),
+    (18, 'Add TableVersion change counters for conditional GETs', _create_table_versions),
+    (19, 'Partition BookReturnDetail by year and fold in legacy BookReturn rows', _partition_returns_ledger),
+    (20, 'Add CirculationDaily/LoanSnapshot analytics rollups', _create_analytics_rollups),
+    (21, 'Count TableVersion changes per session so writers never wait on a counter', _count_table_versions_per_session),
+    (22, 'Index Book.book_id byte-wise for ID prefix lookups', _index_book_id_prefixes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def connect(database_url=None):
+    """Open a dedicated connection from DATABASE_URL"""
+    database_url = database_url or os.getenv('DATABASE_URL')
+    if not database_url:
+        raise ValueError("DATABASE_URL environment variable is required")
+    parsed = urlparse.urlparse(database_url)
+    return psycopg2.connect(
+        database=parsed.path[1:],  # Remove leading '/'
+        user=parsed.username,
+        password=parsed.password,
+        host=parsed.hostname,
+        port=parsed.port
+    )
+
+def _ensure_version_table(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version(
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def _version_table_exists(cur):
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    return cur.fetchone()[0]
+
+def current_version(conn):
+    """Return the highest applied migration version (0 for a fresh or pre-versioning database)"""
+    cur = conn.cursor()
+    if not _version_table_exists(cur):
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+def applied_versions(conn):
+    """Return the set of applied migration versions"""
+    cur = conn.cursor()
+    if not _version_table_exists(cur):
+        return set()
+    cur.execute("SELECT version FROM schema_version")
+    return {row[0] for row in cur.fetchall()}
+
+def run_migrations(conn, verbose=True):
+    """Apply every pending migration in order; returns the list of versions applied"""
+    applied = []
+    cur = conn.cursor()
+    # Serialize concurrent runners (several instances deploying at once)
+    cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+    conn.commit()
+    try:
+        _ensure_version_table(cur)
+        conn.commit()
+        done = applied_versions(conn)
+        for version, description, step in MIGRATIONS:
+            if version in done:
+                continue
+            if verbose:
+                print(f"Applying migration {version}: {description}")
+            try:
+                step(cur)
+                cur.execute("INSERT INTO schema_version(version, description) VALUES (%s, %s)",
+                            (version, description))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"ERROR: migration {version} ({description}) failed: {e}")
+                raise
+            applied.append(version)
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        conn.commit()
+    if verbose:
+        if applied:
+            print(f"Database migrated to version {LATEST_VERSION} ({len(applied)} step(s) applied)")
+        else:
+            print(f"Database already at version {LATEST_VERSION}")
+    return applied
+
+def print_status(conn):
+    done = applied_versions(conn)
+    print(f"Current schema version: {current_version(conn)} (latest: {LATEST_VERSION})")
+    for version, description, _ in MIGRATIONS:
+        print(f"  [{'x' if version in done else ' '}] {version}: {description}")
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    conn = connect()
+    try:
+        if '--status' in argv:
+            print_status(conn)
+        else:
+            run_migrations(conn)
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,501 @@
+"""Database-backed email outbox for the AOA Library.
+
+Emails are INSERTed into EmailOutbox in the same transaction as the change they
+announce, so a confirmation exists exactly when its assignment or return commits
+and survives restarts and deploys. Every web worker runs a Dispatcher thread, but
+the app lets only the scheduler leader's send (see Dispatcher's `active`); rows are
+claimed with FOR UPDATE SKIP LOCKED, so even two overlapping senders never send a
+row twice. Failed sends are retried with exponential backoff; after
+EMAIL_MAX_ATTEMPTS (or a permanent error) a row is parked as 'dead' until an
+admin requeues it.
+
+Row states: pending -> sending -> sent, or back to pending (retry), or dead.
+A 'sending' row whose lease expired (its worker died mid-send) is claimed again.
+
+Each round claims up to EMAIL_CONCURRENCY * EMAIL_BATCH_SIZE messages and sends them
+as provider batch calls (when the transport has send_batch) on a small thread pool,
+throttled by a token bucket of EMAIL_RATE_PER_SECOND provider requests. The bucket
+is per process, which is why only one process sends: it is then the deployment's rate.
+A batch the provider rejects is resent one message at a time, renewing the lease
+while that runs so no other worker claims the chunk meanwhile.
+
+    python outbox.py --self-check    # claims, leases, backoff, dead letters and batch fallback, on a temp table
+"""
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+import dbutil
+
+MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', '8'))
+RETRY_BASE_SECONDS = float(os.getenv('EMAIL_RETRY_BASE_SECONDS', '30'))
+RETRY_MAX_SECONDS = float(os.getenv('EMAIL_RETRY_MAX_SECONDS', '21600'))
+# Messages per provider call (Resend's batch endpoint takes up to 100)
+BATCH_SIZE = int(os.getenv('EMAIL_BATCH_SIZE', '100'))
+# Provider calls in flight at once, per process
+CONCURRENCY = int(os.getenv('EMAIL_CONCURRENCY', '4'))
+# Provider requests per second, per process (Resend's default team limit is 2/s; 0 disables)
+RATE_PER_SECOND = float(os.getenv('EMAIL_RATE_PER_SECOND', '2'))
+POLL_SECONDS = float(os.getenv('EMAIL_POLL_SECONDS', '5'))
+LEASE_SECONDS = int(os.getenv('EMAIL_LEASE_SECONDS', '120'))
+RETENTION_DAYS = int(os.getenv('EMAIL_RETENTION_DAYS', '30'))
+
+class PermanentError(Exception):
+    """A send that can never succeed (bad address, sending disabled); the row goes straight to dead"""
+
+def enqueue(cur, to_email, subject, body, dedupe_key=None, text=None):
+    """Add an email to the outbox in the caller's transaction; returns its id (None if dedupe_key was already queued)"""
+    cur.execute("""
+        INSERT INTO EmailOutbox(to_email, subject, body, text_body, dedupe_key)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (dedupe_key) DO NOTHING
+        RETURNING id
+    """, (to_email, subject, body, text, dedupe_key))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return row['id'] if isinstance(row, dict) else row[0]
+
+def claim(conn, limit=BATCH_SIZE, lease_seconds=LEASE_SECONDS):
+    """Lease up to `limit` due messages to this worker and commit; returns them as dicts"""
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE EmailOutbox o
+        SET status = 'sending', attempts = o.attempts + 1,
+            locked_until = now() + make_interval(secs => %s)
+        FROM (
+            SELECT id FROM EmailOutbox
+            WHERE status IN ('pending', 'sending') AND next_attempt_at <= now()
+              AND (locked_until IS NULL OR locked_until < now())
+            ORDER BY next_attempt_at, id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ) due
+        WHERE o.id = due.id
+        RETURNING o.id, o.to_email, o.subject, o.body, o.text_body, o.attempts
+    """, (lease_seconds, limit))
+    messages = dbutil.dict_rows(cur)
+    conn.commit()
+    for message in messages:
+        # Stable per message, so a provider that supports it drops a resend after a crash
+        message['idempotency_key'] = f"aoa-outbox-{message['id']}"
+    return messages
+
+def extend_lease(conn, ids, lease_seconds=LEASE_SECONDS):
+    """Renew the lease on messages still being sent and commit"""
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE EmailOutbox SET locked_until = now() + make_interval(secs => %s)
+        WHERE id = ANY(%s) AND status = 'sending'
+    """, (lease_seconds, list(ids)))
+    conn.commit()
+
+def retry_delay(attempts):
+    """Seconds to wait before attempt number attempts + 1 (exponential with +-20% jitter)"""
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+def mark_sent(cur, message_id, provider_id=None):
+    cur.execute("""
+        UPDATE EmailOutbox
+        SET status = 'sent', sent_at = now(), provider_id = %s, locked_until = NULL, last_error = NULL
+        WHERE id = %s
+    """, (provider_id, message_id))
+
+def mark_sent_many(cur, sent):
+    """Record a list of (message id, provider id) pairs as sent in one statement"""
+    if not sent:
+        return
+    cur.execute("""
+        UPDATE EmailOutbox o
+        SET status = 'sent', sent_at = now(), provider_id = s.provider_id, locked_until = NULL, last_error = NULL
+        FROM unnest(%s::bigint[], %s::text[]) AS s(id, provider_id)
+        WHERE o.id = s.id
+    """, ([message_id for message_id, _ in sent], [provider_id for _, provider_id in sent]))
+
+def mark_failed(cur, message, error, permanent=False):
+    """Schedule a retry with backoff, or park the message as dead; returns the new status"""
+    dead = permanent or message['attempts'] >= MAX_ATTEMPTS
+    cur.execute("""
+        UPDATE EmailOutbox
+        SET status = %s, locked_until = NULL, last_error = %s,
+            next_attempt_at = now() + make_interval(secs => %s)
+        WHERE id = %s
+    """, ('dead' if dead else 'pending', str(error)[:1000],
+          0 if dead else retry_delay(message['attempts']), message['id']))
+    return 'dead' if dead else 'pending'
+
+def requeue_dead(cur, ids=None):
+    """Give dead messages (all, or the given ids) a fresh set of attempts; returns how many"""
+    cur.execute(f"""
+        UPDATE EmailOutbox
+        SET status = 'pending', attempts = 0, next_attempt_at = now(), last_error = NULL
+        WHERE status = 'dead' {'AND id = ANY(%s)' if ids else ''}
+    """, (list(ids),) if ids else None)
+    return cur.rowcount
+
+def purge_sent(cur, days=RETENTION_DAYS):
+    """Delete sent messages older than `days`; returns how many"""
+    cur.execute("DELETE FROM EmailOutbox WHERE status = 'sent' AND sent_at < now() - make_interval(days => %s)",
+                (days,))
+    return cur.rowcount
+
+def stats(cur):
+    """Message counts per status, the oldest due message and the latest dead letters"""
+    cur.execute("SELECT status, COUNT(*) AS n FROM EmailOutbox GROUP BY status")
+    counts = {row['status']: row['n'] for row in dbutil.dict_rows(cur)}
+    cur.execute("""
+        SELECT id, to_email, subject, attempts, last_error, created_at
+        FROM EmailOutbox WHERE status = 'dead'
+        ORDER BY id DESC LIMIT 20
+    """)
+    dead = dbutil.dict_rows(cur)
+    for row in dead:
+        row['created_at'] = row['created_at'].isoformat()
+    cur.execute("SELECT EXTRACT(EPOCH FROM now() - MIN(next_attempt_at)) AS lag FROM EmailOutbox "
+                "WHERE status IN ('pending', 'sending') AND next_attempt_at <= now()")
+    lag = dbutil.dict_rows(cur)[0]['lag']
+    return {'counts': counts, 'oldest_due_seconds': float(lag) if lag is not None else 0.0, 'dead': dead}
+
+def batch_idempotency_key(messages):
+    """Same key for the same set of messages, so a retried batch call is not delivered twice"""
+    digest = hashlib.sha1(",".join(str(m['id']) for m in sorted(messages, key=lambda m: m['id'])).encode())
+    return f"aoa-outbox-batch-{digest.hexdigest()}"
+
+class TokenBucket:
+    """Thread-safe token bucket: acquire() blocks until a token is free (rate <= 0 never blocks)"""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class FakeTransport:
+    """Local stand-in for Resend: records messages instead of sending them (EMAIL_TRANSPORT=fake)
+
+    For the self-check, fail_times makes the first N sends raise (PermanentError
+    with permanent=True), and a message to an address in `reject` always raises
+    PermanentError; a batch holding one is rejected whole, as Resend does.
+    """
+    def __init__(self, fail_times=0, permanent=False, reject=()):
+        self.sent = []
+        self.fail_times = fail_times
+        self.permanent = permanent
+        self.reject = set(reject)
+        self._lock = threading.Lock()
+
+    def __call__(self, message):
+        with self._lock:
+            if message['to_email'] in self.reject:
+                raise PermanentError(f"fake transport rejects {message['to_email']}")
+            if self.fail_times > 0:
+                self.fail_times -= 1
+                error = PermanentError if self.permanent else RuntimeError
+                raise error("fake transport failure")
+            self.sent.append(message)
+            provider_id = f"fake-{len(self.sent)}"
+        print(f"[fake-email] to={message['to_email']} subject={message['subject']!r} id={provider_id}")
+        return provider_id
+
+    def send_batch(self, messages):
+        rejected = [m['to_email'] for m in messages if m['to_email'] in self.reject]
+        if rejected:
+            raise PermanentError(f"fake transport rejects the batch: {', '.join(rejected)}")
+        return [self(message) for message in messages]
+
+class Dispatcher:
+    """Background thread that drains the outbox through a transport
+    
+    `transport(message)` returns the provider id or raises; an optional
+    `transport.send_batch(messages)` returns, per message, a provider id or the
+    exception that message failed with (raising fails the whole batch).
+    `connection` is a context manager factory yielding a database connection
+    (e.g. ConnectionPool.connection); one is checked out only to claim, renew
+    or record, never while a provider call is in flight. Call wake() after
+    committing new messages to send them without waiting for the next poll.
+    `active()`, when given, is asked before each round: while it returns False
+    this process sends nothing (the app passes its scheduler's leadership).
+    """
+    def __init__(self, connection, transport, batch_size=BATCH_SIZE, poll_seconds=POLL_SECONDS,
+                 concurrency=CONCURRENCY, rate_per_second=RATE_PER_SECOND, lease_seconds=LEASE_SECONDS,
+                 active=None):
+        self.connection = connection
+        self.active = active
+        self.transport = transport
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size if hasattr(transport, 'send_batch') else 1
+        self.concurrency = max(1, concurrency)
+        self.poll_seconds = poll_seconds
+        self.bucket = TokenBucket(rate_per_second)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='email-send')
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_purge = 0.0
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _send_one(self, message):
+        self.bucket.acquire()
+        try:
+            return message, self.transport(message)
+        except Exception as e:
+            return message, e
+
+    def _deliver(self, chunk, leased_at):
+        """Send one chunk; returns (message, provider id or exception) pairs"""
+        if len(chunk) == 1:
+            return [self._send_one(chunk[0])]
+        self.bucket.acquire()
+        try:
+            return list(zip(chunk, self.transport.send_batch(chunk)))
+        except PermanentError:
+            # The provider rejected the batch: send one by one so only the bad messages fail.
+            # At the provider's rate limit that can outlast the lease, so renew it on the whole
+            # chunk (nothing is recorded until it is done) whenever half of it has passed.
+            results = []
+            for message in chunk:
+                if time.monotonic() - leased_at > self.lease_seconds / 2:
+                    with self.connection() as conn:
+                        extend_lease(conn, [m['id'] for m in chunk], self.lease_seconds)
+                    leased_at = time.monotonic()
+                results.append(self._send_one(message))
+            return results
+        except Exception as e:
+            return [(message, e) for message in chunk]
+
+    def _record(self, results):
+        """Record one chunk's outcomes and commit; returns (sent, to retry, dead)"""
+        delivered = []
+        failed = dead = 0
+        with self.connection() as conn:
+            cur = conn.cursor()
+            for message, outcome in results:
+                if not isinstance(outcome, Exception):
+                    delivered.append((message['id'], outcome))
+                    continue
+                permanent = isinstance(outcome, PermanentError)
+                status = mark_failed(cur, message, outcome if permanent else f"{type(outcome).__name__}: {outcome}",
+                                     permanent=permanent)
+                if status == 'dead':
+                    dead += 1
+                else:
+                    failed += 1
+                print(f"Email {message['id']} to {message['to_email']} failed "
+                      f"(attempt {message['attempts']}/{MAX_ATTEMPTS}, now {status}): {type(outcome).__name__}: {outcome}")
+            mark_sent_many(cur, delivered)
+            conn.commit()
+        return len(delivered), failed, dead
+
+    def run_once(self):
+        """Claim and deliver one round of messages; returns the number of messages handled"""
+        started = time.monotonic()
+        with self.connection() as conn:
+            messages = claim(conn, self.batch_size * self.concurrency, self.lease_seconds)
+        leased_at = time.monotonic()
+        chunks = [messages[i:i + self.batch_size] for i in range(0, len(messages), self.batch_size)]
+        sent = failed = dead = 0
+        # Record each chunk as soon as it finishes so a crash never resends a delivered message
+        # and a slow chunk does not hold the others' outcomes past their lease
+        for future in as_completed([self._executor.submit(self._deliver, chunk, leased_at) for chunk in chunks]):
+            counts = self._record(future.result())
+            sent, failed, dead = sent + counts[0], failed + counts[1], dead + counts[2]
+        if messages:
+            print(f"Email dispatcher: {sent} sent, {failed} to retry, {dead} dead "
+                  f"in {time.monotonic() - started:.2f}s")
+        if time.time() - self._last_purge > 3600:
+            self._last_purge = time.time()
+            with self.connection() as conn:
+                purged = purge_sent(conn.cursor())
+                conn.commit()
+            if purged:
+                print(f"Email outbox: purged {purged} sent message(s) older than {RETENTION_DAYS} days")
+        return len(messages)
+
+    def _run(self):
+        print("Email dispatcher thread started")
+        while not self._stop.is_set():
+            try:
+                # Keep draining while full rounds come back
+                while (self.is_active() and self.run_once() == self.batch_size * self.concurrency
+                       and not self._stop.is_set()):
+                    pass
+            except Exception as e:
+                print(f"ERROR in email dispatcher: {type(e).__name__}: {e}")
+            self._wakeup.wait(self.poll_seconds)
+            self._wakeup.clear()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def is_active(self):
+        """Whether this process sends (always, unless an `active` callable says otherwise)"""
+        return self.active is None or bool(self.active())
+
+def _rows(cur, sql, params=None):
+    cur.execute(sql, params)
+    return dbutil.dict_rows(cur)
+
+def _check_claim(conn, cur):
+    """Claims share nothing, and a lease whose worker died is claimed again"""
+    for n in range(3):
+        enqueue(cur, f"claim{n}@example.invalid", "self-check", "claim")
+    conn.commit()
+    first = claim(conn, limit=2)
+    second = claim(conn, limit=10)
+    problems = []
+    if len(first) != 2 or len(second) != 1 or {m['id'] for m in first} & {m['id'] for m in second}:
+        problems.append(f"claimed {len(first)} then {len(second)} messages, expected 2 then 1 others")
+    if claim(conn, limit=10):
+        problems.append("claimed a message still under lease")
+    # The worker holding the first message died: its lease runs out
+    cur.execute("UPDATE EmailOutbox SET locked_until = now() - interval '1 second' WHERE id = %s",
+                (first[0]['id'],))
+    conn.commit()
+    again = claim(conn, limit=10)
+    if [(m['id'], m['attempts']) for m in again] != [(first[0]['id'], 2)]:
+        problems.append(f"after the lease expired claimed {[(m['id'], m['attempts']) for m in again]}, "
+                        f"expected [({first[0]['id']}, 2)]")
+    return problems
+
+def _check_backoff(conn, cur, dispatcher):
+    """A failed send goes back to pending with a later next_attempt_at, then succeeds"""
+    message_id = enqueue(cur, "backoff@example.invalid", "self-check", "backoff")
+    conn.commit()
+    dispatcher.transport.fail_times = 1
+    dispatcher.run_once()
+    problems = []
+    row = _rows(cur, "SELECT status, attempts, next_attempt_at > now() AS later FROM EmailOutbox WHERE id = %s",
+                (message_id,))[0]
+    if (row['status'], row['attempts'], row['later']) != ('pending', 1, True):
+        problems.append(f"after a failed send the message is {row}, expected pending, 1 attempt, retry later")
+    if dispatcher.run_once():
+        problems.append("a message waiting for its retry was sent before next_attempt_at")
+    cur.execute("UPDATE EmailOutbox SET next_attempt_at = now() WHERE id = %s", (message_id,))
+    conn.commit()
+    dispatcher.run_once()
+    status = _rows(cur, "SELECT status FROM EmailOutbox WHERE id = %s", (message_id,))[0]['status']
+    if status != 'sent':
+        problems.append(f"the retry left the message {status}, expected sent")
+    return problems
+
+def _check_dead_letters(conn, cur, dispatcher):
+    """A permanent error, or the last allowed attempt failing, parks the message until requeued"""
+    rejected = enqueue(cur, "rejected@example.invalid", "self-check", "permanent error")
+    exhausted = enqueue(cur, "exhausted@example.invalid", "self-check", "out of attempts")
+    cur.execute("UPDATE EmailOutbox SET attempts = %s WHERE id = %s", (MAX_ATTEMPTS - 1, exhausted))
+    conn.commit()
+    dispatcher.transport.fail_times = 1
+    dispatcher.run_once()
+    problems = []
+    statuses = {row['id']: row['status'] for row in _rows(cur, "SELECT id, status FROM EmailOutbox")}
+    if statuses != {rejected: 'dead', exhausted: 'dead'}:
+        problems.append(f"statuses {statuses}, expected both dead")
+    requeued = requeue_dead(cur, [exhausted])
+    conn.commit()
+    row = _rows(cur, "SELECT status, attempts FROM EmailOutbox WHERE id = %s", (exhausted,))[0]
+    if requeued != 1 or (row['status'], row['attempts']) != ('pending', 0):
+        problems.append(f"requeue_dead left {row}, expected pending with 0 attempts")
+    return problems
+
+def _check_batch_fallback(conn, cur, dispatcher):
+    """A rejected batch is resent one by one, so only the bad message fails"""
+    ids = {enqueue(cur, f"batch{n}@example.invalid", "self-check", "batch") for n in range(3)}
+    rejected = enqueue(cur, "rejected@example.invalid", "self-check", "batch")
+    conn.commit()
+    dispatcher.run_once()
+    statuses = {row['id']: row['status'] for row in _rows(cur, "SELECT id, status FROM EmailOutbox")}
+    expected = {message_id: 'sent' for message_id in ids}
+    expected[rejected] = 'dead'
+    return [] if statuses == expected else [f"statuses {statuses}, expected {expected}"]
+
+def self_check(conn):
+    """Exercise claims, leases, backoff, dead letters and the batch fallback on a
+    temporary copy of EmailOutbox, through FakeTransport; returns [(name, problems)] for failures
+
+    The copy is a TEMP table named EmailOutbox, which shadows the real one for this
+    connection only, so running dispatchers never see the test messages.
+    """
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE EmailOutbox (LIKE public.EmailOutbox INCLUDING ALL)")
+    conn.commit()
+
+    @contextmanager
+    def connection():
+        yield conn
+
+    dispatcher = Dispatcher(connection, FakeTransport(reject=['rejected@example.invalid']),
+                            batch_size=10, concurrency=1, rate_per_second=0)
+    failures = []
+    try:
+        for name, check in (("claim and lease expiry", lambda: _check_claim(conn, cur)),
+                            ("retry backoff", lambda: _check_backoff(conn, cur, dispatcher)),
+                            ("dead letters and requeue", lambda: _check_dead_letters(conn, cur, dispatcher)),
+                            ("rejected batch resent one by one", lambda: _check_batch_fallback(conn, cur, dispatcher))):
+            problems = check()
+            print(f"  [{'FAIL' if problems else ' ok '}] {name}" + (f": {'; '.join(problems)}" if problems else ''))
+            if problems:
+                failures.append((name, problems))
+            cur.execute("DELETE FROM EmailOutbox")
+            conn.commit()
+    finally:
+        dispatcher._executor.shutdown()
+        conn.rollback()
+        cur.execute("DROP TABLE IF EXISTS pg_temp.EmailOutbox")
+        conn.commit()
+    return failures
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] != ['--self-check']:
+        print(__doc__)
+        return 0
+    import migrations
+    conn = migrations.connect()
+    try:
+        print("Email outbox self-check (EmailOutbox is left untouched):")
+        failures = self_check(conn)
+    finally:
+        conn.close()
+    if failures:
+        print(f"{len(failures)} outbox check{'' if len(failures) == 1 else 's'} failed")
+        return 1
+    print("Outbox claims, retries, dead letters and batch fallback work")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
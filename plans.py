@@ -0,0 +1,221 @@
+"""Query plan checks for the AOA Library's hot queries.
+
+Each check EXPLAINs one of the queries the desk and the daily jobs run most -
+a student's loans, copy availability, title lookups, catalog and returns pages,
+the reminder scan - and fails unless the plan uses the indexes that query was
+built around, or if it reads one of the big tables with a Seq Scan. That is
+what a dropped index or a rewrite no index can serve (a CAST on a join key, a
+function around a sort column) looks like. Sequential scans are disabled for the
+check (SET LOCAL enable_seqscan = off) so a small table does not make one look
+cheaper, but join order still follows the table statistics, so the tables need
+realistic data. With --seed the checks run in a scratch database (DATABASE_URL's
+name + "_plans", dropped afterwards) that is migrated and seeded with PLANS_SEED_ROWS
+copies and returns, so a missing index fails without production data; that is
+the mode to run after schema changes or query rewrites. It exits 1 when a check fails:
+
+    python plans.py --seed     # scratch database, migrated and seeded (needs CREATE DATABASE)
+    python plans.py            # the live database
+    python plans.py --verbose  # also print each plan
+"""
+import json
+import os
+import sys
+import urllib.parse as urlparse
+from contextlib import contextmanager
+from datetime import timedelta
+
+import dbutil
+import reminders
+import returns
+
+# Copies and returns --seed generates (a tenth as many titles, a twentieth as many students)
+SEED_ROWS = int(os.getenv('PLANS_SEED_ROWS', '100000'))
+
+# Tables a hot query must never read with a Seq Scan (partitions count as their parent)
+INDEXED_TABLES = ('book', 'bookissue', 'login', 'bookreturndetail', 'reminderledger')
+
+# (name, indexes the plan must use, SQL, parameters) for the queries app.py runs per request;
+# a tuple in place of an index name means any one of those
+CHECKS = [
+    ("student's copies of a title (/api/get_student_books)",
+     ('idx_bookissue_stdid_serial', ('book_pkey', 'idx_book_title_book_id')),
+     "SELECT b.book_id FROM BookIssue i JOIN Book b ON b.serial=i.serial "
+     "WHERE i.stdid=%s AND b.title=%s ORDER BY b.book_id", ('1', 'x')),
+    ("student's borrowed titles (/api/get_titles)", ('idx_bookissue_stdid_serial',),
+     "SELECT DISTINCT b.title FROM BookIssue i JOIN Book b ON b.serial=i.serial "
+     "WHERE i.stdid=%s ORDER BY b.title", ('1',)),
+    ("copy on loan (edit/delete/return)", ('uq_bookissue_book_id',),
+     "SELECT 1 FROM BookIssue WHERE book_id=%s", ('x',)),
+    ("available copies of a title (checkout)", ('idx_book_title_book_id', 'uq_bookissue_book_id'),
+     "SELECT b.book_id FROM Book b WHERE b.title=%s AND NOT EXISTS "
+     "(SELECT 1 FROM BookIssue i WHERE i.book_id=b.book_id) ORDER BY b.book_id", ('x',)),
+    ("copies under an ID prefix (accession and catalog import)", ('idx_book_book_id_prefix',),
+     "SELECT MAX(CAST(SUBSTRING(b.book_id FROM 7) AS BIGINT)) FROM Book b "
+     "WHERE b.book_id COLLATE \"C\" >= %s AND b.book_id COLLATE \"C\" < %s || chr(1114111) "
+     "AND SUBSTRING(b.book_id FROM 7) ~ '^[0-9]{1,18}$'", ('B00001', 'B00001')),
+    ("student by ID (checkout and return emails)", ('idx_login_userid',),
+     "SELECT name, email FROM Login WHERE userid=%s", ('1',)),
+    ("catalog page sorted by title (/api/books)", ('idx_book_title_key',),
+     "SELECT b.book_id FROM Book b WHERE (COALESCE(b.title, ''), b.book_id) > (%s, %s) "
+     "ORDER BY COALESCE(b.title, '') ASC, b.book_id ASC LIMIT 101", ('x', 'x')),
+    ("catalog page sorted by author, newest first (/api/books)", ('idx_book_author_key',),
+     "SELECT b.book_id FROM Book b WHERE (COALESCE(b.author, ''), b.book_id) < (%s, %s) "
+     "ORDER BY COALESCE(b.author, '') DESC, b.book_id DESC LIMIT 101", ('x', 'x')),
+    # PostgreSQL 18 can skip-scan the (returned, stdid, title) index for one student, newest first
+    ("student's returns history (/api/returns?student_id=)",
+     (('idx_bookreturndetail_stdid', 'idx_bookreturndetail_returned'),),
+     "SELECT d.returned, d.stdid, d.title FROM BookReturnDetail d WHERE d.stdid = %s "
+     "GROUP BY d.returned, d.stdid, d.title ORDER BY d.returned DESC, d.stdid DESC, d.title DESC LIMIT 101",
+     ('1',)),
+]
+
+def _scans(plan):
+    """(node type, relation, index) for every scan node in `plan` (an EXPLAIN JSON node)"""
+    found = []
+    if 'Relation Name' in plan or 'Index Name' in plan:
+        found.append((plan.get('Node Type'), plan.get('Relation Name'), plan.get('Index Name')))
+    for child in plan.get('Plans', []):
+        found.extend(_scans(child))
+    return found
+
+def _parent(relation):
+    # bookreturndetail_y2025 -> bookreturndetail
+    return next((table for table in INDEXED_TABLES if relation == table or relation.startswith(table + '_')),
+                relation)
+
+def explain(cur, sql, params):
+    """The plan (EXPLAIN JSON root node) of `sql` with sequential scans disabled"""
+    cur.execute("SET LOCAL enable_seqscan = off")
+    cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    row = cur.fetchone()
+    document = next(iter(row.values())) if isinstance(row, dict) else row[0]
+    if isinstance(document, str):
+        document = json.loads(document)
+    return document[0]['Plan']
+
+def _reminder_check(cur):
+    # The SQL reminders.py builds for today's run
+    sql, params = reminders._pending(cur, reminders.today(), True, True)
+    return ("reminder scan (daily-reminders)", ('idx_bookissue_exp', 'reminderledger_pkey'), sql, params)
+
+def _parent_indexes(cur):
+    """Partition index name -> the partitioned table's index it belongs to"""
+    cur.execute("""
+        SELECT c.relname AS child, p.relname AS parent
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+        WHERE c.relkind = 'i'
+    """)
+    return {row['child']: row['parent'] for row in dbutil.dict_rows(cur)}
+
+def seed(cur, rows=SEED_ROWS):
+    """Fill a freshly migrated database with `rows` copies and returns, then ANALYZE it
+
+    Every fifth copy is on loan, due from two months ago to two weeks ahead, with
+    its first overdue reminder recorded; the returns cover the last three years.
+    """
+    on = reminders.today()
+    students, titles = max(rows // 20, 1), max(rows // 10, 1)
+    cur.execute("""
+        INSERT INTO Login(name, userid, email)
+        SELECT 'Student ' || n, CAST(n AS TEXT), 'student' || n || '@example.invalid'
+        FROM generate_series(1, %s) AS n
+    """, (students,))
+    cur.execute("""
+        INSERT INTO Book(subject, title, author, book_id)
+        SELECT 'Subject ' || n %% 20, 'Title ' || n %% %s, 'Author ' || n %% 997, 'B' || LPAD(CAST(n AS TEXT), 7, '0')
+        FROM generate_series(1, %s) AS n
+    """, (titles, rows))
+    cur.execute("""
+        INSERT INTO BookIssue(stdid, serial, issue, exp, book_id, assigned_by)
+        SELECT CAST(1 + serial %% %s AS TEXT), serial, due - 14, due, book_id, 'seed'
+        FROM (SELECT serial, book_id, CAST(%s AS DATE) + 14 - serial %% 75 AS due FROM Book WHERE serial %% 5 = 0) b
+    """, (students, on))
+    returns.ensure_partitions(cur, range(on.year - 3, on.year + 1))
+    cur.execute("""
+        INSERT INTO BookReturnDetail(stdid, title, book_id, issue, returned, exp, returned_by, assigned_by)
+        SELECT CAST(1 + n %% %s AS TEXT), 'Title ' || n %% %s, 'B' || LPAD(CAST(n AS TEXT), 7, '0'),
+               returned - 10 - n %% 7, returned, returned - n %% 7 + 4, 'seed', 'seed'
+        FROM (SELECT n, CAST(%s AS DATE) - n %% 1095 AS returned FROM generate_series(1, %s) AS n) r
+    """, (students, titles, on, rows))
+    cur.execute("""
+        INSERT INTO ReminderLedger(stdid, serial, issue, exp, tier)
+        SELECT stdid, serial, issue, exp, 1 FROM BookIssue WHERE exp <= %s
+    """, (on - timedelta(days=1),))
+    reminders.advance(cur, on - timedelta(days=1))
+    for table in INDEXED_TABLES:
+        cur.execute(f"ANALYZE {table}")
+    cur.connection.commit()
+
+@contextmanager
+def scratch_database(suffix='_plans'):
+    """A new, empty database next to DATABASE_URL's, dropped afterwards; yields its URL"""
+    import migrations
+    admin = migrations.connect()
+    admin.autocommit = True
+    url = urlparse.urlparse(os.getenv('DATABASE_URL'))
+    name = url.path[1:] + suffix
+    cur = admin.cursor()
+    try:
+        cur.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+        cur.execute(f'CREATE DATABASE "{name}"')
+        yield urlparse.urlunparse(url._replace(path='/' + name))
+    finally:
+        cur.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+        admin.close()
+
+def check_seeded(rows=SEED_ROWS, verbose=False):
+    """check() in a scratch database migrated to the latest version and seeded with `rows` rows"""
+    import migrations
+    with scratch_database() as url:
+        conn = migrations.connect(url)
+        try:
+            migrations.run_migrations(conn, verbose=False)
+            seed(conn.cursor(), rows)
+            print(f"Hot query plans on a scratch database seeded with {rows} copies and returns:")
+            return check(conn.cursor(), verbose)
+        finally:
+            conn.close()
+
+def check(cur, verbose=False):
+    """Run every check in a transaction that is rolled back; returns [(name, problems)] for failures"""
+    failures = []
+    try:
+        parents = _parent_indexes(cur)
+        for name, expected, sql, params in CHECKS + [_reminder_check(cur)]:
+            plan = explain(cur, sql, params)
+            scans = _scans(plan)
+            used = {parents.get(index, index) for _, _, index in scans if index}
+            wanted = [(index,) if isinstance(index, str) else index for index in expected]
+            problems = [f"does not use {' or '.join(options)}" for options in wanted if not used & set(options)]
+            problems += sorted({f"Seq Scan on {_parent(relation)}" for node, relation, _ in scans
+                                if node == 'Seq Scan' and _parent(relation) in INDEXED_TABLES})
+            print(f"  [{'FAIL' if problems else ' ok '}] {name}" + (f": {'; '.join(problems)}" if problems else ''))
+            if verbose:
+                print(json.dumps(plan, indent=2, default=str))
+            if problems:
+                failures.append((name, problems))
+    finally:
+        cur.connection.rollback()
+    return failures
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    verbose = '--verbose' in argv
+    if '--seed' in argv:
+        failures = check_seeded(verbose=verbose)
+    else:
+        import migrations
+        conn = migrations.connect()
+        try:
+            print("Hot query plans:")
+            failures = check(conn.cursor(), verbose)
+        finally:
+            conn.close()
+    if failures:
+        print(f"{len(failures)} hot quer{'y' if len(failures) == 1 else 'ies'} no longer use their indexes")
+        return 1
+    print("Every hot query uses its indexes")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
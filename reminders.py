@@ -0,0 +1,140 @@
+"""Reminder ledger for the AOA Library's daily due-date reminders.
+
+Each loan (student, copy, issue date, due date) gets at most one "due tomorrow"
+reminder and one reminder per overdue escalation tier - by default after 1, 3, 7
+and 14 days (REMINDER_TIERS). Sent reminders are recorded in ReminderLedger in the
+same transaction that queues the email, and ReminderState records the last date
+a run processed.
+
+A run compares each loan due tomorrow or overdue - an index range scan on
+BookIssue(exp) - at its current tier with the highest tier the ledger holds
+for it, so what it reads grows with the overdue loans, not with every open one.
+It does not depend on when the previous run happened: a loan that skipped tiers
+(downtime, or restored or inserted with a due date already past a tier) gets
+one reminder for the tier it is on now. The ledger is keyed by the due date,
+so extending a loan starts its tiers over.
+"""
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+import pytz
+
+import dates
+import dbutil
+import scheduler
+
+TIERS = tuple(sorted(int(t) for t in os.getenv('REMINDER_TIERS', '1,3,7,14').split(',')))
+LEDGER_DAYS = int(os.getenv('REMINDER_LEDGER_DAYS', '365'))
+
+def today():
+    """Today's date in the scheduler's timezone (the reminder run's notion of 'today')"""
+    return datetime.now(pytz.timezone(scheduler.TIMEZONE)).date()
+
+def advance(cur, processed_through):
+    cur.execute("""
+        INSERT INTO ReminderState(id, processed_through) VALUES (TRUE, %s)
+        ON CONFLICT (id) DO UPDATE SET processed_through = GREATEST(ReminderState.processed_through, EXCLUDED.processed_through)
+    """, (processed_through,))
+
+# Loans with a reminder due: due tomorrow (tier 0), or overdue at a tier the ledger does not
+# hold yet. A loan's current tier is the highest of TIERS its due date has passed by, so a
+# loan that skipped tiers gets just that one. Students without an email are left out.
+_PENDING_SQL = """
+    WITH due AS (
+        SELECT i.stdid, i.serial, i.book_id, i.issue, i.exp,
+               CASE WHEN i.exp = %(tomorrow)s THEN 0
+                    ELSE (SELECT MAX(t.tier) FROM unnest(%(tiers)s::int[]) AS t(tier)
+                          WHERE i.exp <= CAST(%(on)s AS DATE) - t.tier) END AS tier
+        FROM BookIssue i
+        WHERE ({where}) AND i.stdid IS NOT NULL AND i.serial IS NOT NULL AND i.issue IS NOT NULL
+    )
+    SELECT l.userid, l.name, l.email, b.title, d.book_id, d.serial, d.issue, d.exp, d.tier,
+           CAST(%(on)s AS DATE) - d.exp AS days_overdue
+    FROM due d
+    JOIN Login l ON l.userid = d.stdid
+    JOIN Book b ON b.serial = d.serial
+    WHERE COALESCE(l.email, '') <> ''
+      AND NOT EXISTS (
+          SELECT 1 FROM ReminderLedger r
+          WHERE r.stdid = d.stdid AND r.serial = d.serial AND r.issue = d.issue AND r.exp = d.exp
+            AND r.tier >= d.tier
+      )
+"""
+
+def _pending(cur, on, due_tomorrow, overdue):
+    """The pending-loans query and its parameters for date `on`"""
+    # Literal date bounds, so each branch is a range scan on BookIssue(exp) the planner can estimate
+    where = []
+    if due_tomorrow:
+        where.append("i.exp = %(tomorrow)s")
+    if overdue:
+        where.append("i.exp <= %(first_tier)s")
+    if not where:
+        return None, None
+    params = {'on': on, 'tomorrow': on + timedelta(days=1), 'first_tier': on - timedelta(days=TIERS[0]),
+              'tiers': list(TIERS)}
+    return _PENDING_SQL.format(where=' OR '.join(where)), params
+
+def pending_loans(cur, on, due_tomorrow=True, overdue=True):
+    """One row per loan with a new reminder due on date `on`, oldest due date first"""
+    sql, params = _pending(cur, on, due_tomorrow, overdue)
+    if sql is None:
+        return []
+    cur.execute(sql + " ORDER BY d.exp, d.book_id", params)
+    return dbutil.dict_rows(cur)
+
+def pending_digests(cur, on):
+    """One row per student with JSON lists of their newly overdue and due-tomorrow loans"""
+    sql, params = _pending(cur, on, True, True)
+    cur.execute(f"""
+        WITH pending AS ({sql})
+        SELECT userid, name, email, MAX(tier) AS top_tier,
+               COALESCE(json_agg(json_build_object('title', title, 'book_id', book_id, 'serial', serial,
+                                                   'issue', issue, 'exp', exp, 'tier', tier,
+                                                   'days_overdue', days_overdue)
+                                 ORDER BY exp, book_id) FILTER (WHERE tier > 0), '[]') AS overdue,
+               COALESCE(json_agg(json_build_object('title', title, 'book_id', book_id, 'serial', serial,
+                                                   'issue', issue, 'exp', exp, 'tier', tier)
+                                 ORDER BY book_id) FILTER (WHERE tier = 0), '[]') AS due_tomorrow
+        FROM pending
+        GROUP BY userid, name, email
+        ORDER BY userid
+    """, params)
+    students = dbutil.dict_rows(cur)
+    # json_agg turns dates into 'YYYY-MM-DD' strings; hand templates real dates again
+    for row in students:
+        for loan in row['overdue'] + row['due_tomorrow']:
+            loan['issue'], loan['exp'] = dates.to_date(loan['issue']), dates.to_date(loan['exp'])
+    return students
+
+def digest_key(row, on):
+    """Outbox dedupe key for one student's digest: the same loans and tiers on the same day never go out twice,
+    a digest with different loans (a later run, new overdue tiers) does"""
+    loans = sorted((loan['serial'], str(loan['issue']), str(loan['exp']), loan['tier'])
+                   for loan in row['overdue'] + row['due_tomorrow'])
+    digest = hashlib.sha1(repr(loans).encode()).hexdigest()[:16]
+    return f"digest:{row['userid']}:{on}:{digest}"
+
+def record(cur, stdid_loans):
+    """Add (stdid, loan) pairs to the ledger; a loan is a dict with serial, issue, exp and tier"""
+    if not stdid_loans:
+        return
+    cur.execute("""
+        INSERT INTO ReminderLedger(stdid, serial, issue, exp, tier)
+        SELECT * FROM unnest(%s::text[], %s::integer[], %s::date[], %s::date[], %s::integer[])
+        ON CONFLICT DO NOTHING
+    """, ([stdid for stdid, _ in stdid_loans], [loan['serial'] for _, loan in stdid_loans],
+          [loan['issue'] for _, loan in stdid_loans], [loan['exp'] for _, loan in stdid_loans],
+          [loan['tier'] for _, loan in stdid_loans]))
+
+def purge(cur):
+    """Forget ledger rows older than REMINDER_LEDGER_DAYS for loans no longer open (an open loan's
+    rows are what keep its reminders from being resent)"""
+    cur.execute("""
+        DELETE FROM ReminderLedger r
+        WHERE r.sent_at < now() - make_interval(days => %s)
+          AND NOT EXISTS (SELECT 1 FROM BookIssue i WHERE i.stdid = r.stdid AND i.serial = r.serial
+                                                      AND i.issue = r.issue AND i.exp = r.exp)
+    """, (LEDGER_DAYS,))
+    return cur.rowcount
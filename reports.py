@@ -0,0 +1,318 @@
+"""Offline circulation reports for the AOA Library (term-end and yearly reporting).
+
+Two steps, so the number crunching never runs against the live database:
+
+snapshot  COPY Book, Login, BookIssue and BookReturnDetail out in one read-only
+          transaction (one consistent point in time) into gzipped CSV files, one
+          per table, plus manifest.json. It is a few sequential scans; run it after
+          hours, or set REPORTS_DATABASE_URL to a read replica.
+build     Load a snapshot into NumPy columns - dates as day numbers, students, titles
+          and subjects dictionary-encoded as integer codes - compute one metric column
+          per statistic for the period with boolean masks and sum each by student,
+          title and subject with bincount, then write students.csv, titles.csv,
+          subjects.csv and report.html. Builds only read the snapshot files, so any
+          period can be rebuilt anywhere.
+
+    python reports.py snapshot [DIR]      # default: reports/snapshot-YYYYMMDD-HHMMSS
+    python reports.py build SNAPSHOT_DIR [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--out DIR]
+
+A loan counts as a checkout in the period it started in and as a return in the period
+it came back in; open and overdue loans are as of the last day of the period. The
+period defaults to the snapshot's calendar year up to the day it was taken.
+"""
+import csv
+import gc
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import date, datetime
+
+import numpy as np
+from jinja2 import Environment, FileSystemLoader
+
+REPORTS_DIR = os.getenv('REPORTS_DIR', 'reports')
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'report')
+# Rows shown per table in report.html; the CSV files have every row
+HTML_TOP = 25
+
+SNAPSHOT_QUERIES = {
+    'book': "SELECT book_id, title, subject FROM Book",
+    'login': "SELECT userid, name FROM Login",
+    'bookissue': "SELECT stdid, book_id, issue, exp FROM BookIssue",
+    'bookreturndetail': "SELECT stdid, title, book_id, issue, returned, exp, copies FROM BookReturnDetail",
+}
+
+STUDENT_COLUMNS = ('stdid', 'name', 'checkouts', 'returns', 'average_loan_days', 'overdue_return_rate',
+                   'open_loans', 'overdue_loans')
+TITLE_COLUMNS = ('title', 'subject', 'copies', 'checkouts', 'borrowers', 'turnover', 'returns',
+                 'average_loan_days', 'overdue_return_rate', 'open_loans', 'overdue_loans')
+SUBJECT_COLUMNS = ('subject', 'titles', 'copies', 'checkouts', 'borrowers', 'turnover', 'returns',
+                   'average_loan_days', 'overdue_return_rate', 'open_loans', 'overdue_loans')
+
+# Day number of loans that have not come back; later than any period end
+_OPEN = date.max.toordinal()
+
+def _print_progress(message):
+    print(f"[reports] {message}", flush=True)
+
+def snapshot(conn, directory):
+    """COPY the reporting tables into `directory`; returns the manifest"""
+    os.makedirs(directory, exist_ok=True)
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cur = conn.cursor()
+    cur.execute("SELECT CURRENT_DATE, now()")
+    as_of, taken_at = cur.fetchone()
+    rows = {}
+    for table, query in SNAPSHOT_QUERIES.items():
+        with gzip.open(os.path.join(directory, f"{table}.csv.gz"), 'wt', encoding='utf-8', newline='') as f:
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", f)
+        rows[table] = cur.rowcount
+    conn.rollback()
+    manifest = {'as_of': as_of.isoformat(), 'taken_at': taken_at.isoformat(), 'rows': rows}
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def _read_columns(directory, table):
+    """{column: tuple of strings} for one snapshot file; NULL reads as ''"""
+    with gzip.open(os.path.join(directory, f"{table}.csv.gz"), 'rt', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        columns = list(zip(*reader)) or [()] * len(header)
+    return dict(zip(header, columns))
+
+class _Codes:
+    """Dictionary encoding: each distinct value gets the next integer code"""
+
+    def __init__(self):
+        self.values = []
+        self._index = {}
+
+    def encode(self, values):
+        # Loop over the distinct values only; the per-row lookups run in C through map()
+        index = self._index
+        for value in dict.fromkeys(values):
+            if value not in index:
+                index[value] = len(self.values)
+                self.values.append(value)
+        return np.fromiter(map(index.__getitem__, values), np.int64, len(values))
+
+def _day_numbers(texts):
+    """Date strings as day ordinals, 0 for NULL; each distinct date is parsed once"""
+    parsed = {text: date.fromisoformat(text).toordinal() if text else 0 for text in dict.fromkeys(texts)}
+    return np.fromiter(map(parsed.__getitem__, texts), np.int64, len(texts))
+
+def load(directory):
+    """A snapshot as one row per loan, open (from BookIssue) or returned (from BookReturnDetail), by column"""
+    # Millions of short-lived row tuples and nothing cyclic: collector passes would only add time
+    gc.disable()
+    try:
+        return _load(directory)
+    finally:
+        gc.enable()
+
+def _load(directory):
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    book = _read_columns(directory, 'book')
+    login = _read_columns(directory, 'login')
+    issued = _read_columns(directory, 'bookissue')
+    returned = _read_columns(directory, 'bookreturndetail')
+
+    title_of = dict(zip(book['book_id'], book['title']))
+    subject_of = dict(zip(book['book_id'], book['subject']))
+    # Legacy returns and copies deleted since have no book_id in Book: use the title's subject
+    title_subject = {}
+    for title, subject in zip(book['title'], book['subject']):
+        title_subject.setdefault(title, subject)
+
+    students, titles, subjects = _Codes(), _Codes(), _Codes()
+    open_count = len(issued['stdid'])
+    loans = {
+        'student': students.encode(returned['stdid'] + issued['stdid']),
+        'title': titles.encode(returned['title'] + tuple(title_of.get(b, '') for b in issued['book_id'])),
+        'subject': subjects.encode(
+            [subject_of.get(b) or title_subject.get(t, '') for b, t in zip(returned['book_id'], returned['title'])]
+            + [subject_of.get(b, '') for b in issued['book_id']]),
+        'issue': _day_numbers(returned['issue'] + issued['issue']),
+        'exp': _day_numbers(returned['exp'] + issued['exp']),
+        'returned': np.concatenate([_day_numbers(returned['returned']), np.full(open_count, _OPEN, np.int64)]),
+        'copies': np.concatenate([np.array(returned['copies'], np.int64), np.ones(open_count, np.int64)]),
+    }
+    # Copies on the shelf list, by title and by subject
+    stock = {'title': titles.encode(book['title']), 'subject': subjects.encode(book['subject'])}
+    return {
+        'manifest': manifest,
+        'loans': loans,
+        'stock': stock,
+        'students': students.values,
+        'titles': titles.values,
+        'subjects': subjects.values,
+        'names': dict(zip(login['userid'], login['name'])),
+        'title_subject': title_subject,
+    }
+
+def _group_sum(keys, values, size):
+    """Sum `values` by integer code"""
+    # bincount adds the weights as float64: exact for integer sums below 2**53
+    return np.bincount(keys, weights=values, minlength=size).astype(np.int64)
+
+def _group_count(keys, size):
+    return np.bincount(keys, minlength=size)
+
+def _group_distinct(keys, members, size):
+    """Distinct `members` per integer code, ignoring members coded -1"""
+    member = members >= 0
+    # One integer per (key, member) pair, so np.unique finds the distinct pairs
+    width = int(members.max(initial=0)) + 1
+    pairs = np.unique(keys[member] * width + members[member])
+    return np.bincount(pairs // width, minlength=size)
+
+def _rate(part, whole):
+    return round(part / whole, 4) if whole else None
+
+def _average(total, count):
+    return round(total / count, 2) if count else None
+
+def _metrics(loans, start, end):
+    """One copies-weighted column per statistic for the period [start, end]"""
+    first, last = start.toordinal(), end.toordinal()
+    copies, issue, returned, exp = loans['copies'], loans['issue'], loans['returned'], loans['exp']
+    checkouts = np.where((issue >= first) & (issue <= last), copies, 0)
+    returns = np.where((returned >= first) & (returned <= last), copies, 0)
+    # Loan length needs the issue date and the overdue rate the due date; legacy rows lack them
+    timed = np.where(issue != 0, returns, 0)
+    dated = np.where(exp != 0, returns, 0)
+    open_loans = np.where((issue <= last) & (returned > last), copies, 0)
+    return {
+        'checkouts': checkouts,
+        'returns': returns,
+        'timed_returns': timed,
+        'loan_days': timed * (returned - issue),
+        'dated_returns': dated,
+        'overdue_returns': np.where(returned > exp, dated, 0),
+        'open_loans': open_loans,
+        'overdue_loans': np.where((exp != 0) & (exp < last), open_loans, 0),
+    }
+
+def _rows(sums, size):
+    """Per-code dicts of the summed metrics plus the derived rates, skipping codes with no activity"""
+    active = np.flatnonzero(sums['checkouts'] | sums['returns'] | sums['open_loans'])
+    # Back to Python ints for the CSV writer and the template
+    columns = {name: column[active].tolist() for name, column in sums.items()}
+    rows = []
+    for i, code in enumerate(active.tolist()):
+        row = {name: column[i] for name, column in columns.items()}
+        row['code'] = code
+        row['average_loan_days'] = _average(row['loan_days'], row['timed_returns'])
+        row['overdue_return_rate'] = _rate(row['overdue_returns'], row['dated_returns'])
+        rows.append(row)
+    return rows
+
+def statistics(snap, start, end):
+    """Totals and per-student, per-title and per-subject statistics for [start, end]"""
+    loans = snap['loans']
+    metrics = _metrics(loans, start, end)
+    # The borrowing student of each checkout in the period, -1 for other rows
+    borrowed = np.where(metrics['checkouts'] != 0, loans['student'], -1)
+    titles_per_subject = {}
+    for subject in snap['title_subject'].values():
+        titles_per_subject[subject] = titles_per_subject.get(subject, 0) + 1
+    report = {'from': start, 'to': end, 'as_of': snap['manifest']['as_of']}
+
+    for group, names in (('student', snap['students']), ('title', snap['titles']), ('subject', snap['subjects'])):
+        keys, size = loans[group], len(names)
+        sums = {name: _group_sum(keys, column, size) for name, column in metrics.items()}
+        if group != 'student':
+            sums['borrowers'] = _group_distinct(keys, borrowed, size)
+            sums['copies'] = _group_count(snap['stock'][group], size)
+        rows = _rows(sums, size)
+        for row in rows:
+            if group == 'student':
+                row['stdid'] = names[row['code']]
+                row['name'] = snap['names'].get(row['stdid'], '')
+            else:
+                row[group] = names[row['code']]
+                row['turnover'] = _average(row['checkouts'], row['copies'])
+            if group == 'title':
+                row['subject'] = snap['title_subject'].get(row['title'], '')
+            elif group == 'subject':
+                row['titles'] = titles_per_subject.get(row['subject'], 0)
+        rows.sort(key=lambda row: (-row['checkouts'], -row['returns'], row['code']))
+        report[f"{group}s"] = rows
+
+    totals = {name: int(column.sum()) for name, column in metrics.items()}
+    totals['borrowers'] = np.unique(borrowed[borrowed >= 0]).size
+    totals['average_loan_days'] = _average(totals['loan_days'], totals['timed_returns'])
+    totals['overdue_return_rate'] = _rate(totals['overdue_returns'], totals['dated_returns'])
+    report['totals'] = totals
+    return report
+
+def _write_csv(path, columns, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows([row[column] for column in columns] for row in rows)
+
+def write_reports(report, out_dir):
+    """students.csv, titles.csv, subjects.csv and report.html in `out_dir`"""
+    os.makedirs(out_dir, exist_ok=True)
+    _write_csv(os.path.join(out_dir, 'students.csv'), STUDENT_COLUMNS, report['students'])
+    _write_csv(os.path.join(out_dir, 'titles.csv'), TITLE_COLUMNS, report['titles'])
+    _write_csv(os.path.join(out_dir, 'subjects.csv'), SUBJECT_COLUMNS, report['subjects'])
+    env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=True, trim_blocks=True, lstrip_blocks=True)
+    html = env.get_template('circulation.html').render(report=report, top=HTML_TOP,
+                                                       generated=datetime.now().strftime('%Y-%m-%d %H:%M'))
+    with open(os.path.join(out_dir, 'report.html'), 'w', encoding='utf-8') as f:
+        f.write(html)
+
+def build(snapshot_dir, start=None, end=None, out_dir=None):
+    """Load a snapshot, compute the statistics and write the reports; returns (out_dir, report)"""
+    started = time.time()
+    snap = load(snapshot_dir)
+    as_of = date.fromisoformat(snap['manifest']['as_of'])
+    end = end or as_of
+    start = start or date(end.year, 1, 1)
+    if start > end:
+        raise ValueError("'--from' is after '--to'")
+    _print_progress(f"Loaded {len(snap['loans']['copies'])} loan row(s) in {time.time() - started:.2f}s")
+    report = statistics(snap, start, end)
+    out_dir = out_dir or os.path.join(REPORTS_DIR, f"circulation-{start:%Y%m%d}-{end:%Y%m%d}")
+    write_reports(report, out_dir)
+    _print_progress(f"Built {out_dir} in {time.time() - started:.2f}s")
+    return out_dir, report
+
+def _option(argv, name):
+    if name not in argv:
+        return argv, None
+    i = argv.index(name)
+    return argv[:i] + argv[i + 2:], argv[i + 1]
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    argv, start = _option(argv, '--from')
+    argv, end = _option(argv, '--to')
+    argv, out_dir = _option(argv, '--out')
+    if argv[:1] == ['snapshot'] and len(argv) <= 2:
+        import migrations
+        directory = argv[1] if len(argv) == 2 else os.path.join(REPORTS_DIR, f"snapshot-{datetime.now():%Y%m%d-%H%M%S}")
+        started = time.time()
+        # Falls back to DATABASE_URL when no replica is configured
+        conn = migrations.connect(os.getenv('REPORTS_DATABASE_URL'))
+        try:
+            manifest = snapshot(conn, directory)
+        finally:
+            conn.close()
+        counts = ', '.join(f"{table} {rows}" for table, rows in manifest['rows'].items())
+        _print_progress(f"Snapshot {directory} ({counts}) in {time.time() - started:.2f}s")
+        return 0
+    if argv[:1] == ['build'] and len(argv) == 2:
+        build(argv[1], start and date.fromisoformat(start), end and date.fromisoformat(end), out_dir)
+        return 0
+    print(__doc__)
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
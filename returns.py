@@ -0,0 +1,185 @@
+"""Returns ledger for the AOA Library: every check-in ever made, one row per copy.
+
+BookReturnDetail is range-partitioned by return date, one partition per calendar
+year plus a default partition for dates outside them, so a page of recent
+returns only touches the newest partition however long the history gets. The
+leader's daily 'return-partitions' job creates next year's partition ahead of time.
+
+Rows from the legacy BookReturn summary table (a copy count per student, title
+and date, from before per-copy details were kept) are folded in once with
+book_id NULL and their copy count, and BookReturn is dropped. Restoring a dump
+brings back a plain BookReturnDetail (and an old dump a BookReturn), so restores
+run install() again.
+
+The history page and /api/returns list one row per (return date, student, title),
+newest first, with keyset pagination and date and student filters.
+
+    python returns.py              # show the partitions and their row counts
+"""
+import sys
+from datetime import date
+
+import dbutil
+
+def _values(cur):
+    return [next(iter(row.values())) if isinstance(row, dict) else row[0] for row in cur.fetchall()]
+
+def _table_exists(cur, name):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL AS present", (name,))
+    return _values(cur)[0]
+
+def is_partitioned(cur):
+    cur.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('bookreturndetail')")
+    return cur.fetchone() is not None
+
+def partition_years(cur):
+    """Years that have their own partition"""
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('bookreturndetail')
+    """)
+    prefix = 'bookreturndetail_y'
+    return sorted(int(name[len(prefix):]) for name in _values(cur) if name.startswith(prefix))
+
+def _create_table(cur):
+    cur.execute('''
+        CREATE TABLE BookReturnDetail(
+            stdid TEXT NOT NULL, title TEXT NOT NULL, book_id TEXT,
+            issue DATE, returned DATE NOT NULL, returned_by TEXT,
+            copies INTEGER NOT NULL DEFAULT 1,
+            exp DATE, assigned_by TEXT
+        ) PARTITION BY RANGE (returned)
+    ''')
+    cur.execute("CREATE TABLE bookreturndetail_default PARTITION OF BookReturnDetail DEFAULT")
+
+def _create_indexes(cur):
+    # Newest-first pages walk the first index backwards; a student's history uses the second
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookreturndetail_returned ON BookReturnDetail(returned, stdid, title)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookreturndetail_stdid ON BookReturnDetail(stdid, returned)")
+    # The analytics rollup finds loans by the day they started
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookreturndetail_issue ON BookReturnDetail(issue)")
+
+def ensure_partitions(cur, years):
+    """Create the partitions for `years` that are missing, moving their rows out of the default partition"""
+    created = []
+    for year in sorted(set(int(y) for y in years) - set(partition_years(cur))):
+        name = f"bookreturndetail_y{year}"
+        start, end = date(year, 1, 1), date(year + 1, 1, 1)
+        cur.execute(f"CREATE TABLE {name} (LIKE BookReturnDetail INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        cur.execute(f"""
+            WITH moved AS (
+                DELETE FROM bookreturndetail_default WHERE returned >= %s AND returned < %s RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """, (start, end))
+        cur.execute(f"ALTER TABLE BookReturnDetail ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+                    (start, end))
+        created.append(year)
+    return created
+
+def ensure_upcoming(cur, today=None):
+    """This year's and next year's partitions (the daily 'return-partitions' job)"""
+    year = (today or date.today()).year
+    return ensure_partitions(cur, [year, year + 1])
+
+def _years(cur, table):
+    cur.execute(f"SELECT DISTINCT CAST(EXTRACT(YEAR FROM returned) AS INTEGER) FROM {table} WHERE returned IS NOT NULL")
+    return _values(cur)
+
+def install(cur):
+    """Partition BookReturnDetail and fold in legacy BookReturn rows; a no-op once done"""
+    if not is_partitioned(cur):
+        cur.execute("ALTER TABLE BookReturnDetail RENAME TO bookreturndetail_unpartitioned")
+        _create_table(cur)
+        ensure_partitions(cur, _years(cur, 'bookreturndetail_unpartitioned'))
+        # The original table lacks the newer columns; a restored dump of the ledger has them
+        cur.execute("SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name = 'bookreturndetail_unpartitioned'")
+        present = set(_values(cur))
+        copies = "COALESCE(copies, 1)" if 'copies' in present else "1"
+        extra = ', '.join(column if column in present else 'NULL' for column in ('exp', 'assigned_by'))
+        # Rows written before these columns were enforced: a missing return date falls back to the issue date
+        cur.execute(f"""
+            INSERT INTO BookReturnDetail(stdid, title, book_id, issue, returned, returned_by, copies, exp, assigned_by)
+            SELECT COALESCE(stdid, ''), COALESCE(title, ''), book_id, issue,
+                   COALESCE(returned, issue, CURRENT_DATE), returned_by, {copies}, {extra}
+            FROM bookreturndetail_unpartitioned
+        """)
+        cur.execute("DROP TABLE bookreturndetail_unpartitioned")
+    if _table_exists(cur, 'bookreturn'):
+        ensure_partitions(cur, _years(cur, 'BookReturn'))
+        # Summaries the old returns page showed because no detail rows covered them
+        cur.execute("""
+            INSERT INTO BookReturnDetail(stdid, title, book_id, issue, returned, returned_by, copies)
+            SELECT COALESCE(r.stdid, ''), COALESCE(r.title, ''), NULL, r.issue,
+                   COALESCE(r.returned, r.issue, CURRENT_DATE), NULL, COALESCE(r.copies, 1)
+            FROM BookReturn r
+            WHERE NOT EXISTS (
+                SELECT 1 FROM BookReturnDetail d
+                WHERE d.stdid = COALESCE(r.stdid, '') AND d.title = COALESCE(r.title, '')
+                  AND d.returned = r.returned AND d.book_id IS NOT NULL
+            )
+        """)
+        print(f"Returns ledger: folded {cur.rowcount} legacy BookReturn row(s) into BookReturnDetail")
+        cur.execute("DROP TABLE BookReturn")
+    ensure_upcoming(cur)
+    _create_indexes(cur)
+
+def page(cur, start=None, end=None, student_id=None, after=None, limit=100):
+    """Up to `limit` return groups, newest first; `after` is the (returned, stdid, title) of the previous page's last row
+
+    Each group is one (return date, student, title) with the copies' IDs, or
+    '(N copies)' for legacy rows that have none.
+    """
+    where, params = [], []
+    if start:
+        where.append("d.returned >= %s")
+        params.append(start)
+    if end:
+        where.append("d.returned <= %s")
+        params.append(end)
+    if student_id:
+        where.append("d.stdid = %s")
+        params.append(student_id)
+    if after:
+        where.append("(d.returned, d.stdid, d.title) < (%s, %s, %s)")
+        params.extend(after)
+    # Group in index order and stop after `limit` groups, then look up the names
+    cur.execute(f"""
+        SELECT p.returned, p.stdid, COALESCE(l.name, p.stdid) AS student, p.title,
+               COALESCE(p.ids, '(' || CAST(p.copies AS TEXT) || ' copies)') AS ids,
+               p.copies, p.issue, p.returned_by
+        FROM (
+            SELECT d.returned, d.stdid, d.title,
+                   STRING_AGG(d.book_id, ', ' ORDER BY d.book_id) AS ids,
+                   SUM(d.copies) AS copies, MIN(d.issue) AS issue, MAX(d.returned_by) AS returned_by
+            FROM BookReturnDetail d
+            {'WHERE ' + ' AND '.join(where) if where else ''}
+            GROUP BY d.returned, d.stdid, d.title
+            ORDER BY d.returned DESC, d.stdid DESC, d.title DESC
+            LIMIT %s
+        ) p
+        LEFT JOIN Login l ON l.userid = p.stdid
+        ORDER BY p.returned DESC, p.stdid DESC, p.title DESC
+    """, params + [limit])
+    return dbutil.dict_rows(cur)
+
+def main(argv=None):
+    import migrations
+    conn = migrations.connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass('bookreturndetail')
+            ORDER BY c.relname
+        """)
+        for name, bound, rows in cur.fetchall():
+            print(f"{name:<28} {bound:<60} ~{max(int(rows), 0)} row(s)")
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""Cluster-safe scheduler for the AOA Library's daily jobs.
+
+Every web worker runs a Scheduler thread, but only one of them - the leader - runs
+jobs. Leadership is a session-level Postgres advisory lock held on a dedicated
+connection: if the leader's process or connection dies, the lock is released and
+another worker takes over on its next poll. Followers look for a leader on a
+pooled connection and only open their own to take the lock when there is none,
+so the whole deployment keeps one scheduler connection open, not one per worker.
+
+Job times are wall-clock times in SCHEDULER_TIMEZONE (default Africa/Nairobi), not
+server-local time. Each job's next_run_at lives in ScheduledJob, so a run that was
+missed while the app was down happens once as soon as a leader is back. Every run
+is recorded in JobRun with its duration and outcome; /admin/scheduler shows both.
+
+A run is claimed by moving next_run_at forward with a conditional UPDATE before the
+job starts, so even two overlapping leaders (e.g. during a network partition)
+cannot start the same scheduled run twice.
+"""
+import os
+import socket
+import threading
+import time
+import traceback
+import zlib
+from datetime import datetime, timedelta
+
+import pytz
+
+import dbutil
+
+TIMEZONE = os.getenv('SCHEDULER_TIMEZONE', 'Africa/Nairobi')
+POLL_SECONDS = float(os.getenv('SCHEDULER_POLL_SECONDS', '30'))
+HISTORY_DAYS = int(os.getenv('SCHEDULER_HISTORY_DAYS', '90'))
+
+# Advisory lock key shared by every worker of this app
+LOCK_KEY = zlib.crc32(b'aoa-library-scheduler')
+
+# pg_locks rows of the leader's lock: a single-key advisory lock (objsubid 1; the two-int
+# form has 2) splits its 64-bit key into classid (high) and objid (low), and the database
+# must be ours, since another database's scheduler on the same server takes the same key
+_LEADER_LOCK = """
+    l.locktype = 'advisory' AND l.granted AND l.objsubid = 1
+    AND l.database = (SELECT oid FROM pg_database WHERE datname = current_database())
+    AND l.classid = 0 AND l.objid = %s
+"""
+
+class Job:
+    """A job that runs every day at `at` ('HH:MM') in the scheduler's timezone"""
+    def __init__(self, name, func, at):
+        hour, minute = (int(part) for part in at.split(':'))
+        self.name = name
+        self.func = func
+        self.at = f"{hour:02d}:{minute:02d}"
+        self.hour, self.minute = hour, minute
+
+    def schedule(self, tz):
+        return f"daily at {self.at} {tz.zone}"
+
+    def next_after(self, moment, tz):
+        """First run time strictly after `moment` (an aware datetime)"""
+        local = moment.astimezone(tz)
+        day = local.date()
+        while True:
+            candidate = tz.localize(datetime(day.year, day.month, day.day, self.hour, self.minute))
+            if candidate > local:
+                return candidate
+            day += timedelta(days=1)
+
+class Scheduler:
+    """Per-worker thread that competes for leadership and runs due jobs while leader
+
+    `connect()` must return a new DB-API connection; the scheduler keeps one open for
+    as long as it holds the advisory lock. `pooled` is a context manager factory
+    yielding a borrowed connection (e.g. ConnectionPool.connection) for the
+    followers' leader check; without it a follower keeps its connection too.
+    """
+    def __init__(self, connect, jobs, timezone=TIMEZONE, poll_seconds=POLL_SECONDS, pooled=None):
+        self.connect = connect
+        self.pooled = pooled
+        self.jobs = {job.name: job for job in jobs}
+        self.tz = pytz.timezone(timezone)
+        self.poll_seconds = poll_seconds
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+        self._conn = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def _now(self):
+        return datetime.now(pytz.utc)
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = self.connect()
+            self.is_leader = False
+        return self._conn
+
+    def _drop_connection(self, reason='lost leadership'):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+        if self.is_leader:
+            print(f"Scheduler: {self.worker} {reason}")
+        self.is_leader = False
+
+    def _leader_elsewhere(self):
+        with self.pooled() as conn:
+            cur = conn.cursor()
+            cur.execute(f"SELECT 1 FROM pg_locks l WHERE {_LEADER_LOCK}", (LOCK_KEY,))
+            held = cur.fetchone() is not None
+            conn.rollback()
+        return held
+
+    def _elect(self):
+        """Try to become (or confirm we still are) the leader; returns True while leading"""
+        if not self.is_leader and self.pooled is not None and self._leader_elsewhere():
+            return False
+        conn = self._connection()
+        cur = conn.cursor()
+        if self.is_leader:
+            # Cheap liveness check: a dead connection means the lock is gone too
+            cur.execute("SELECT 1")
+        else:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (LOCK_KEY,))
+            row = cur.fetchone()
+            self.is_leader = bool(row['pg_try_advisory_lock'] if isinstance(row, dict) else row[0])
+            if self.is_leader:
+                print(f"Scheduler: {self.worker} is now the leader")
+        conn.commit()
+        if not self.is_leader and self.pooled is not None:
+            # Lost the race to another worker: followers keep no connection open
+            self._drop_connection()
+        return self.is_leader
+
+    def _sync_jobs(self, cur):
+        """Register new jobs and reschedule ones whose time changed; never runs anything immediately"""
+        now = self._now()
+        cur.execute("SELECT name, schedule FROM ScheduledJob")
+        stored = {row['name']: row['schedule'] for row in dbutil.dict_rows(cur)}
+        for job in self.jobs.values():
+            schedule = job.schedule(self.tz)
+            if stored.get(job.name) == schedule:
+                continue
+            cur.execute("""
+                INSERT INTO ScheduledJob(name, schedule, next_run_at) VALUES (%s, %s, %s)
+                ON CONFLICT (name) DO UPDATE SET schedule = EXCLUDED.schedule, next_run_at = EXCLUDED.next_run_at
+            """, (job.name, schedule, job.next_after(now, self.tz)))
+            print(f"Scheduler: {job.name} scheduled {schedule}")
+
+    def run_pending(self):
+        """Run every job whose next_run_at has passed (leader only); returns the number run"""
+        conn = self._connection()
+        cur = conn.cursor()
+        self._sync_jobs(cur)
+        conn.commit()
+        cur.execute("SELECT name, next_run_at FROM ScheduledJob WHERE next_run_at <= now() ORDER BY next_run_at")
+        due = [row for row in dbutil.dict_rows(cur) if row['name'] in self.jobs]
+        conn.commit()
+        for row in due:
+            self._run(conn, self.jobs[row['name']], row['next_run_at'])
+        return len(due)
+
+    def _run(self, conn, job, scheduled_for):
+        cur = conn.cursor()
+        now = self._now()
+        # Claim this run: only one UPDATE can move next_run_at off the value we read
+        cur.execute("UPDATE ScheduledJob SET next_run_at = %s WHERE name = %s AND next_run_at = %s",
+                    (job.next_after(now, self.tz), job.name, scheduled_for))
+        if cur.rowcount != 1:
+            conn.rollback()
+            return
+        cur.execute("INSERT INTO JobRun(job, scheduled_for, worker) VALUES (%s, %s, %s) RETURNING id",
+                    (job.name, scheduled_for, self.worker))
+        row = cur.fetchone()
+        run_id = row['id'] if isinstance(row, dict) else row[0]
+        conn.commit()
+
+        if now - scheduled_for > timedelta(seconds=max(self.poll_seconds * 2, 120)):
+            print(f"Scheduler: catching up {job.name} run scheduled for {scheduled_for.astimezone(self.tz):%Y-%m-%d %H:%M %Z}")
+        started = time.perf_counter()
+        status, error = 'ok', None
+        try:
+            job.func()
+        except Exception as e:
+            status, error = 'error', f"{type(e).__name__}: {e}\n{traceback.format_exc(limit=5)}"
+            print(f"Scheduler: {job.name} failed: {type(e).__name__}: {e}")
+        duration_ms = int((time.perf_counter() - started) * 1000)
+
+        cur.execute("""
+            UPDATE JobRun SET finished_at = now(), duration_ms = %s, status = %s, error = %s WHERE id = %s
+        """, (duration_ms, status, error, run_id))
+        cur.execute("""
+            UPDATE ScheduledJob SET last_run_at = %s, last_status = %s, last_duration_ms = %s WHERE name = %s
+        """, (now, status, duration_ms, job.name))
+        cur.execute("DELETE FROM JobRun WHERE started_at < now() - make_interval(days => %s)", (HISTORY_DAYS,))
+        conn.commit()
+        print(f"Scheduler: {job.name} finished ({status}) in {duration_ms / 1000:.1f}s")
+
+    def _run_loop(self):
+        while not self._stop.is_set():
+            try:
+                if self._elect():
+                    self.run_pending()
+            except Exception as e:
+                print(f"Scheduler error on {self.worker}: {type(e).__name__}: {e}")
+                # Reconnect (and re-elect) next round; a broken session has lost the lock anyway
+                self._drop_connection()
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+        self._drop_connection('stepped down')
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run_loop, name='job-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def wake(self):
+        self._wake.set()
+
+def request_run(cur, name):
+    """Make a job due now; whichever worker leads runs it on its next poll. Returns False for unknown jobs"""
+    cur.execute("UPDATE ScheduledJob SET next_run_at = now() WHERE name = %s", (name,))
+    return cur.rowcount == 1
+
+def status(cur, runs=20):
+    """Jobs with their next/last run, recent runs (newest first) and the current leader"""
+    cur.execute("SELECT name, schedule, next_run_at, last_run_at, last_status, last_duration_ms FROM ScheduledJob ORDER BY name")
+    jobs = dbutil.dict_rows(cur)
+    cur.execute("""
+        SELECT id, job, scheduled_for, started_at, finished_at, duration_ms, status, error, worker
+        FROM JobRun ORDER BY started_at DESC LIMIT %s
+    """, (runs,))
+    recent = dbutil.dict_rows(cur)
+    cur.execute(f"""
+        SELECT a.pid, a.client_addr, a.backend_start
+        FROM pg_locks l JOIN pg_stat_activity a ON a.pid = l.pid
+        WHERE {_LEADER_LOCK}
+    """, (LOCK_KEY,))
+    leaders = dbutil.dict_rows(cur)
+    return {'jobs': jobs, 'runs': recent, 'leader': leaders[0] if leaders else None}
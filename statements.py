@@ -0,0 +1,135 @@
+"""SQL statement layer behind CursorWrapper: cached placeholder translation and prepared statements.
+
+App code writes SQLite-style ? placeholders. translate() turns them into
+psycopg2's %s once per distinct SQL string and caches the result, and it leaves
+a ? inside string literals, quoted identifiers, comments and dollar quotes
+alone (the old query.replace('?', '%s') on every call rewrote those too). The
+rest of the text is psycopg2 format as before: %s placeholders pass through and
+a literal % is written %%.
+
+Hot statements (checkout, return and the desk lookups) run with prepare=True:
+the first execution on a connection sends PREPARE, later ones only
+EXECUTE name(params), so Postgres skips parsing and analysis and, once its
+generic plan is as cheap as a custom one, planning too. Prepared statements
+belong to a database session: every pooled connection prepares its own and
+keeps them until it is closed (a rollback does not drop them). If an EXECUTE
+fails, the statement is prepared again under a new name on its next use, so a
+restore that changes a table cannot leave a connection with a broken statement.
+
+    python statements.py --bench 2000    # translation cost and parse/plan savings on the live database
+"""
+import itertools
+import re
+import sys
+import threading
+import weakref
+from functools import lru_cache
+
+import dbutil
+
+# Literals, quoted identifiers, comments and dollar quotes are copied as they are
+_TOKENS = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/|(\$\w*\$).*?\1|\?""", re.S)
+_PYFORMAT = re.compile(r'%[s%]')
+
+@lru_cache(maxsize=1024)
+def translate(query):
+    """A ?-style query in psycopg2 format (%s placeholders)"""
+    if '?' not in query:
+        return query
+    return _TOKENS.sub(lambda m: '%s' if m.group(0) == '?' else m.group(0), query)
+
+def _positional(query):
+    """(PREPARE body with $1..$n placeholders, n) for a query in psycopg2 format"""
+    count = itertools.count(1)
+    # psycopg2 interpolates %s and %% anywhere in the text, literals included, so this does too
+    body = _PYFORMAT.sub(lambda m: '%' if m.group(0) == '%%' else f'${next(count)}', query)
+    return body, next(count) - 1
+
+class PreparedStatements:
+    """The statements prepared on each pooled connection, by query text"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = weakref.WeakKeyDictionary()
+        self._names = itertools.count(1)
+
+    def execute(self, cursor, query, params):
+        """Run `query` (psycopg2 format) on `cursor` as a prepared statement, preparing it on first use"""
+        with self._lock:
+            statements = self._connections.setdefault(cursor.connection, {})
+        prepared = statements.get(query)
+        if prepared is None:
+            body, count = _positional(query)
+            name = f"aoa_stmt_{next(self._names)}"
+            cursor.execute(f"PREPARE {name} AS {body}")
+            arguments = f"({', '.join(['%s'] * count)})" if count else ''
+            prepared = statements[query] = (f"EXECUTE {name}{arguments}", count)
+        execute_sql, count = prepared
+        if len(params) != count:
+            raise ValueError(f"Statement takes {count} parameter(s), got {len(params)}")
+        try:
+            return cursor.execute(execute_sql, params)
+        except Exception:
+            statements.pop(query, None)
+            raise
+
+    def stats(self):
+        with self._lock:
+            per_connection = [len(statements) for statements in self._connections.values()]
+        return {'connections': len(per_connection), 'statements': sum(per_connection)}
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] != ['--bench']:
+        print(__doc__)
+        return 0
+    count = int(argv[1]) if len(argv) > 1 else 2000
+    import migrations
+    conn = migrations.connect()
+    try:
+        cur = conn.cursor()
+        # One student's loans of one title, as /api/get_student_books and the return form look them up
+        cur.execute("SELECT i.stdid, b.title FROM BookIssue i JOIN Book b ON b.serial = i.serial LIMIT 1")
+        sample = cur.fetchone()
+        if sample is None:
+            print("No loans to look up; check out some books first")
+            return 1
+        lookup = ("SELECT b.book_id FROM BookIssue i JOIN Book b ON b.serial=i.serial "
+                  "WHERE i.stdid=? AND b.title=? ORDER BY b.book_id")
+        checkout = """
+            WITH ins AS (
+                INSERT INTO BookIssue(stdid, serial, issue, exp, book_id, assigned_by)
+                SELECT ?, b.serial, CURRENT_DATE, ?, b.book_id, ?
+                FROM Book b
+                WHERE b.book_id = ANY(?) AND b.title = ?
+                ORDER BY b.book_id
+                ON CONFLICT (book_id) WHERE book_id IS NOT NULL DO NOTHING
+                RETURNING book_id, serial
+            )
+            SELECT ins.book_id, b.title FROM ins JOIN Book b ON b.serial = ins.serial
+        """
+        # Copies already on loan, so the checkout statement does all its work and inserts nothing
+        cur.execute("SELECT book_id FROM BookIssue WHERE book_id IS NOT NULL LIMIT 5")
+        on_loan = [row[0] for row in cur.fetchall()]
+        params = (sample[0], sample[1])
+        checkout_params = (sample[0], '2099-01-01', 'bench', on_loan, sample[1])
+
+        print(f"Placeholder translation, {count} calls:")
+        dbutil.timed("query.replace('?', '%s') every call (old)", lambda: [checkout.replace('?', '%s') for _ in range(count)], count)
+        dbutil.timed("translate() (cached)", lambda: [translate(checkout) for _ in range(count)], count)
+
+        prepared = PreparedStatements()
+        for label, query, args in (("student's copies of a title", lookup, params),
+                                   ("checkout CTE (all copies on loan)", checkout, checkout_params)):
+            print(f"{label}, {count} executions:")
+            dbutil.timed("plain execute (parse + plan every call)",
+                         lambda: [cur.execute(translate(query), args) for _ in range(count)], count)
+            prepared.execute(cur, translate(query), args)
+            dbutil.timed("prepared execute",
+                         lambda: [prepared.execute(cur, translate(query), args) for _ in range(count)], count)
+        conn.rollback()
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+// Server-side autocomplete for the assign and return forms.
+// Results come from /api/search/*, so pages no longer ship the whole roster or catalog.
+function setupAutocomplete(options) {
+    const input = options.input;
+    const hidden = options.hidden;
+    const dropdown = options.dropdown;
+    let timer = null;
+    let requestId = 0;
+
+    function choose(item) {
+        hidden.value = item ? options.value(item) : '';
+        input.value = item ? options.text(item) : '';
+        dropdown.style.display = 'none';
+        if (options.onSelect) {
+            options.onSelect(item);
+        }
+    }
+
+    function render(items) {
+        dropdown.innerHTML = '';
+        if (items.length === 0) {
+            const empty = document.createElement('div');
+            empty.className = 'dropdown-option text-muted';
+            empty.textContent = 'No matches';
+            dropdown.appendChild(empty);
+        }
+        items.forEach(item => {
+            const option = document.createElement('div');
+            option.className = 'dropdown-option';
+            option.textContent = options.label ? options.label(item) : options.text(item);
+            option.addEventListener('click', () => choose(item));
+            dropdown.appendChild(option);
+        });
+        dropdown.style.display = 'block';
+    }
+
+    function search() {
+        const id = ++requestId;
+        fetch(options.url(input.value.trim()))
+            .then(res => res.json())
+            .then(items => {
+                // Ignore responses that arrive after a newer keystroke
+                if (id === requestId) {
+                    render(items);
+                }
+            })
+            .catch(error => console.error('Search failed:', error));
+    }
+
+    input.addEventListener('input', function() {
+        if (hidden.value) {
+            hidden.value = '';
+            if (options.onSelect) {
+                options.onSelect(null);
+            }
+        }
+        clearTimeout(timer);
+        timer = setTimeout(search, 150);
+    });
+    input.addEventListener('focus', search);
+
+    // Close the dropdown when clicking outside
+    document.addEventListener('click', function(event) {
+        if (!input.parentElement.contains(event.target)) {
+            dropdown.style.display = 'none';
+        }
+    });
+}
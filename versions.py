@@ -0,0 +1,130 @@
+"""Per-table change counters for HTTP conditional GETs (ETag / Last-Modified).
+
+A statement-level trigger on each tracked table counts the change in the
+writing transaction, so every write path is covered - the app, imports,
+restores and manual SQL - and a rolled back write counts nothing.
+
+TableVersion keeps one counter row per table and database session (backend):
+a trigger only ever updates its own session's row, and a session runs one
+transaction at a time, so concurrent writers never wait on each other for a
+counter. A table's version is the sum of its rows and its change time the
+latest of theirs; compact() folds the rows of sessions that have ended into
+the table's base row (backend 0) without changing the sum.
+
+Base rows start at nextval(table_version_seq) << 32. The sequence is not part
+of any dump, so after a restore brings back an old TableVersion, install()
+moves every table past any version a client could have cached.
+
+    python versions.py             # show the current versions
+    python versions.py --compact   # fold finished sessions' counters
+"""
+import sys
+
+import dbutil
+
+# Tables the cached pages read (lower case, as Postgres reports them to triggers).
+# TitleInventory is derived from book and bookissue and is covered by those.
+TRACKED = ('book', 'bookissue', 'login', 'bookreturndetail', 'deletedbook', 'deletedlogin',
+           'circulationdaily', 'loansnapshot')
+
+# Adds one to the calling session's counter for a table
+_BUMP_SQL = """
+    INSERT INTO TableVersion AS v (name, backend, version, changed_at)
+    SELECT name, pg_backend_pid(), 1, now() FROM unnest(%s::text[]) AS t(name)
+    ON CONFLICT (name, backend) DO UPDATE SET version = v.version + 1, changed_at = now()
+"""
+
+def install(cur):
+    """Create the counters and (re)create the triggers; safe to run again, e.g. after a restore"""
+    cur.execute("CREATE SEQUENCE IF NOT EXISTS table_version_seq")
+    # Dumps taken before per-session counters carry the one-row-per-table layout
+    cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'tableversion' AND column_name = 'backend'")
+    if cur.fetchone() is None:
+        cur.execute("DROP TABLE IF EXISTS TableVersion")
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS TableVersion(
+            name TEXT NOT NULL,
+            backend INTEGER NOT NULL,
+            version BIGINT NOT NULL,
+            changed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (name, backend)
+        )
+    ''')
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO TableVersion AS v (name, backend, version, changed_at)
+            VALUES (TG_TABLE_NAME, pg_backend_pid(), 1, now())
+            ON CONFLICT (name, backend) DO UPDATE SET version = v.version + 1, changed_at = now();
+            RETURN NULL;
+        END
+        $$
+    ''')
+    # Tables added by later migrations get their triggers when those run install() again
+    cur.execute("SELECT name FROM unnest(%s::text[]) AS t(name) WHERE to_regclass(name) IS NOT NULL", (list(TRACKED),))
+    tables = [row['name'] if isinstance(row, dict) else row[0] for row in cur.fetchall()]
+    for table in tables:
+        cur.execute(f"DROP TRIGGER IF EXISTS {table}_version ON {table}")
+        cur.execute(f"CREATE TRIGGER {table}_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table} "
+                    "FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()")
+    cur.execute("DELETE FROM TableVersion")
+    cur.execute("""
+        INSERT INTO TableVersion(name, backend, version)
+        SELECT name, 0, nextval('table_version_seq') << 32 FROM unnest(%s::text[]) AS t(name)
+    """, (tables,))
+
+def bump(cur, *tables):
+    """Mark `tables` changed by a write their triggers do not see (e.g. rebuilding derived data)"""
+    cur.execute(_BUMP_SQL, (list(tables),))
+
+def compact(cur):
+    """Fold the counters of sessions that have ended into the base rows; returns the rows folded"""
+    cur.execute("""
+        WITH gone AS (
+            DELETE FROM TableVersion
+            WHERE backend <> 0 AND backend NOT IN (SELECT pid FROM pg_stat_activity WHERE pid IS NOT NULL)
+            RETURNING name, version, changed_at
+        ), folded AS (
+            SELECT name, SUM(version) AS version, MAX(changed_at) AS changed_at, COUNT(*) AS sessions
+            FROM gone GROUP BY name
+        ), updated AS (
+            UPDATE TableVersion v
+            SET version = v.version + f.version, changed_at = GREATEST(v.changed_at, f.changed_at)
+            FROM folded f
+            WHERE v.name = f.name AND v.backend = 0
+        )
+        SELECT COALESCE(SUM(sessions), 0) FROM folded
+    """)
+    row = cur.fetchone()
+    return int(next(iter(row.values())) if isinstance(row, dict) else row[0])
+
+def current(cur, tables):
+    """(versions in `tables` order, time of the latest change) for the given tracked tables"""
+    cur.execute("SELECT name, SUM(version) AS version, MAX(changed_at) AS changed_at FROM TableVersion "
+                "WHERE name = ANY(%s) GROUP BY name", (list(tables),))
+    rows = {row['name']: row for row in dbutil.dict_rows(cur)}
+    missing = [table for table in tables if table not in rows]
+    if missing:
+        raise KeyError(f"Not tracked in TableVersion: {', '.join(missing)}")
+    return tuple(int(rows[table]['version']) for table in tables), max(rows[table]['changed_at'] for table in tables)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    import migrations
+    conn = migrations.connect()
+    try:
+        cur = conn.cursor()
+        if '--compact' in argv:
+            print(f"Folded {compact(cur)} finished session counter(s)")
+            conn.commit()
+        cur.execute("SELECT name, SUM(version) AS version, MAX(changed_at) AS changed_at, COUNT(*) AS sessions "
+                    "FROM TableVersion GROUP BY name ORDER BY name")
+        for row in dbutil.dict_rows(cur):
+            print(f"{row['name']:<20} {row['version']:>20}  {row['changed_at']:%Y-%m-%d %H:%M:%S %Z}  "
+                  f"({row['sessions']} counter row(s))")
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())